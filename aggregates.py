@@ -0,0 +1,369 @@
+"""Aggregates of the historic data that are built once and reused by the
+callbacks in app.py"""
+
+import collections
+import functools
+
+import numpy as np
+import pandas as pd
+
+import grid
+import sketches
+from boroughs import borough_codes, borough_members, dic_borough
+
+
+# length of a time-of-day slot in the heatmap (seconds)
+HEATMAP_SLOT = 15 * 60
+SECONDS_PER_DAY = 24 * 60 * 60
+NS_PER_SECOND = 10 ** 9
+NS_PER_DAY = SECONDS_PER_DAY * NS_PER_SECOND
+
+# minutes the historic data can be grouped in ("time-div" in app.py) and
+# the slot all of them are multiples of
+TIME_DIVS = (15, 30, 45, 60)
+BASE_SLOT = 15 * 60
+# parts of a time bucket that can be selected by an hour range: the whole
+# bucket, only its first hour or only its last hour
+FULL, HEAD, TAIL = 0, 1, 2
+
+# prefix sums over days of the unique vehicle counts per (borough, day,
+# time bucket, part of bucket) for each time division and prefix sums over
+# days and hours of whether every route was seen. Also HyperLogLog sketches
+# per (borough, day, base slot) for approximate counts, or None.
+# Days only partially covered by a date range are counted from the store
+CountIndex = collections.namedtuple(
+    "CountIndex", ["boroughs", "first_day", "cumulative_counts",
+                   "route_names", "route_flags", "cumulative_routes",
+                   "sketches"])
+
+# dense (time-of-day slot x latitude bin x longitude bin) heatmap on a
+# resolution of the fixed grid (see grid.py)
+HeatmapCube = collections.namedtuple(
+    "HeatmapCube", ["counts", "slot", "resolution", "lat_mids", "lon_mids"])
+
+
+def epoch_seconds(timestamps):
+    """Convert a datetime series into integer seconds since the epoch"""
+    return timestamps.values.astype("datetime64[s]").astype(np.int64)
+
+
+def ping_seconds(ddf):
+    """Integer seconds since the epoch of every ping, from the "seconds"
+    column of the compact schema (see store.py) or from the timestamps"""
+    if "seconds" in ddf:
+        return ddf["seconds"].values.astype(np.int64)
+    return epoch_seconds(ddf.timestamp)
+
+
+def heatmap_counts(ddf, resolution=grid.DEFAULT_RESOLUTION,
+                   slot=HEATMAP_SLOT):
+    """Unique vehicles per time-of-day slot and cell of the grid summed over
+    the time bins of the pings, and the first and last time bin (None if
+    there are no pings). Partial counts of several days add up"""
+    n_slots = SECONDS_PER_DAY // slot
+    n_cells = grid.n_cells(resolution)
+    cells = grid.cells(ddf.latitude, ddf.longitude, resolution)
+    # pings outside the map or without a location are left out
+    located = cells >= 0
+
+    bins = ping_seconds(ddf)[located] // slot
+    cells = cells[located]
+    vehicles = pd.factorize(ddf.vehicle_id.values[located])[0]
+
+    if not bins.size:
+        return np.zeros((n_slots, n_cells)), None, None
+    # a vehicle only counts once per time bin and location bin
+    first_bin = bins.min()
+    key = ((bins - first_bin) * n_cells + cells) * \
+        (vehicles.max() + 1) + vehicles
+    unique_bins = np.unique(key) // (vehicles.max() + 1)
+    bin_slots = (unique_bins // n_cells + first_bin) % n_slots
+    counts = np.bincount(bin_slots * n_cells + unique_bins % n_cells,
+                         minlength=n_slots * n_cells).astype(float)
+    return counts.reshape(n_slots, n_cells), first_bin, bins.max()
+
+
+def heatmap_cube(counts, first_bin, last_bin,
+                 resolution=grid.DEFAULT_RESOLUTION, slot=HEATMAP_SLOT):
+    """Heatmap of the summed counts of heatmap_counts, averaged over every
+    time bin covered by the history, including those where no vehicle was
+    seen"""
+    n_slots = SECONDS_PER_DAY // slot
+    denominator = np.zeros(n_slots)
+    if first_bin is not None:
+        all_bins = np.arange(first_bin, last_bin + 1) % n_slots
+        denominator = np.bincount(all_bins, minlength=n_slots)
+
+    cell_grid = grid.get_grid(resolution)
+    counts = counts.reshape(n_slots, cell_grid.n_lats, cell_grid.n_lons)
+    counts = np.divide(counts, denominator[:, None, None],
+                       out=np.zeros_like(counts),
+                       where=denominator[:, None, None] > 0)
+
+    return HeatmapCube(counts, slot, resolution, cell_grid.lat_mids,
+                       cell_grid.lon_mids)
+
+
+def build_heatmap_cube(ddf, resolution=grid.DEFAULT_RESOLUTION,
+                       slot=HEATMAP_SLOT):
+    """Mean number of unique vehicles per time-of-day slot and cell of the
+    grid"""
+    counts, first_bin, last_bin = heatmap_counts(ddf, resolution, slot)
+    return heatmap_cube(counts, first_bin, last_bin, resolution, slot)
+
+
+def heatmap_slot(cube, hour):
+    """Index of the slot in the cube starting at a fractional hour of the
+    day, or None if no slot starts there"""
+    seconds = int(round(hour * 3600))
+    if seconds % cube.slot != 0 or not 0 <= seconds < SECONDS_PER_DAY:
+        return None
+    return seconds // cube.slot
+
+
+def count_unique(cells, vehicles, n_cells):
+    """Number of unique vehicles in each cell"""
+    n_vehicles = vehicles.max() + 1 if vehicles.size else 1
+    unique_keys = np.unique(cells * n_vehicles + vehicles)
+    return np.bincount(unique_keys // n_vehicles, minlength=n_cells)
+
+
+def bucket_counts(ddf, time_div):
+    """Unique vehicles per day and time bucket, summed over days for every
+    time bucket of the day"""
+    n_buckets = SECONDS_PER_DAY // (time_div * 60)
+    if ddf.empty:
+        return np.zeros(n_buckets, dtype=np.int64)
+
+    seconds = ping_seconds(ddf)
+    days = seconds // SECONDS_PER_DAY
+    days = days - days.min()
+    buckets = seconds % SECONDS_PER_DAY // (time_div * 60)
+    vehicles = pd.factorize(ddf.vehicle_id)[0]
+
+    n_days = days.max() + 1
+    counts = count_unique(days * n_buckets + buckets, vehicles,
+                          n_days * n_buckets)
+    return counts.reshape(n_days, n_buckets).sum(axis=0)
+
+
+@functools.lru_cache(maxsize=None)
+def bucket_labels(time_div):
+    """Timestamps on a fixed day marking the start of every time bucket,
+    as plotted on the time of day axis"""
+    starts = np.arange(SECONDS_PER_DAY // (time_div * 60)) * time_div * 60
+    labels = pd.Timestamp("2015-09-12") + pd.to_timedelta(starts, unit="s")
+    return np.asarray(labels.strftime("%Y-%m-%d %H:%M:%S"))
+
+
+def bucket_hours(time_div):
+    """First and last hour of the day overlapped by every time bucket"""
+    starts = np.arange(SECONDS_PER_DAY // (time_div * 60)) * time_div * 60
+    return starts // 3600, (starts + time_div * 60 - 1) // 3600
+
+
+def bucket_parts(time_div, hours):
+    """Part of every time bucket selected by an hour range (-1 if none)"""
+    first, last = bucket_hours(time_div)
+    first_in = (first >= hours[0]) & (first <= hours[1])
+    last_in = (last >= hours[0]) & (last <= hours[1])
+    return np.select([first_in & last_in, first_in, last_in],
+                     [FULL, HEAD, TAIL], -1)
+
+
+def prefix_sums(values, axes, dtype=np.int64):
+    """Cumulative sums along axes, each starting with a zero, so that the
+    sum over a range lo:hi along an axis is the difference of the entries
+    at hi and lo"""
+    sums = np.pad(values.astype(dtype),
+                  [(1, 0) if axis in axes else (0, 0)
+                   for axis in range(values.ndim)], mode="constant")
+    for axis in axes:
+        np.cumsum(sums, axis=axis, out=sums)
+    return sums
+
+
+def build_count_index(ddf, time_divs=TIME_DIVS, precision=None):
+    """Count unique vehicles per borough, day and time bucket once, so that
+    date and hour ranges only need differences of prefix sums. With a
+    precision, the sketches for approximate counts are built as well"""
+    seconds = ping_seconds(ddf)
+    first_day = seconds.min() // SECONDS_PER_DAY
+    days = seconds // SECONDS_PER_DAY - first_day
+    n_days = days.max() + 1
+    slots = seconds % SECONDS_PER_DAY // BASE_SLOT
+    n_slots = SECONDS_PER_DAY // BASE_SLOT
+    hours = slots * BASE_SLOT // 3600
+
+    vehicles, vehicle_names = pd.factorize(ddf.vehicle_id)
+    routes, route_names = pd.factorize(ddf.route_id)
+    route_names = np.asarray(route_names)
+    n_routes = len(route_names)
+
+    # which routes were seen in every hour of every day
+    route_hours = np.zeros((n_days, 24, n_routes), dtype=bool)
+    route_hours[days, hours, routes] = True
+
+    boroughs = ["All"] + list(dic_borough)
+    bits = borough_codes(ddf)
+    members = borough_members(bits, boroughs)
+    route_flags = {}
+    counts = {div: np.zeros((len(boroughs), n_days,
+                             SECONDS_PER_DAY // (div * 60), 3), dtype=np.int32)
+              for div in time_divs}
+    index_sketches = None
+    if precision is not None:
+        index_sketches = np.zeros((len(boroughs), n_days, n_slots,
+                                   2 ** precision), dtype=np.uint8)
+        vehicle_hashes = sketches.hash_ids(vehicle_names)
+
+    n_vehicles = vehicles.max() + 1
+    for it, borough in enumerate(boroughs):
+        sel = members[:, it]
+        route_flags[borough] = np.bincount(routes[sel],
+                                           minlength=n_routes) > 0
+
+        # every time division is made of whole base slots, so only one
+        # ping per vehicle and base slot is needed from here on
+        unique_keys = np.unique((days[sel] * n_slots + slots[sel]) *
+                                n_vehicles + vehicles[sel])
+        day_slots, slot_vehicles = np.divmod(unique_keys, n_vehicles)
+        slot_days, day_slots = np.divmod(day_slots, n_slots)
+        slot_hours = day_slots * BASE_SLOT // 3600
+        if index_sketches is not None:
+            index_sketches[it] = sketches.build(
+                slot_days * n_slots + day_slots,
+                vehicle_hashes[slot_vehicles], n_days * n_slots,
+                precision).reshape(n_days, n_slots, -1)
+
+        for div in time_divs:
+            n_buckets = SECONDS_PER_DAY // (div * 60)
+            buckets = day_slots * BASE_SLOT // (div * 60)
+            cells = slot_days * n_buckets + buckets
+            first, last = bucket_hours(div)
+            for part, keep in [(FULL, slice(None)),
+                               (HEAD, slot_hours == first[buckets]),
+                               (TAIL, slot_hours == last[buckets])]:
+                counts[div][it, :, :, part] = count_unique(
+                    cells[keep], slot_vehicles[keep],
+                    n_days * n_buckets).reshape(n_days, n_buckets)
+
+    return CountIndex(boroughs, first_day,
+                      {div: prefix_sums(c, [1]) for div, c in counts.items()},
+                      route_names, route_flags,
+                      prefix_sums(route_hours, [0, 1], np.int32),
+                      index_sketches)
+
+
+def sketch_counts(index, rows, lo, hi, hours, time_div):
+    """Approximate unique vehicle counts per borough row of the index and
+    time bucket, summed over the days lo to hi. The sketches of the base
+    slots within the hours are merged into the buckets they belong to"""
+    if index.sketches is None:
+        raise ValueError("The count index was built without sketches")
+    n_buckets = SECONDS_PER_DAY // (time_div * 60)
+    counts = np.zeros((len(rows), n_buckets))
+    first_slot = hours[0] * 3600 // BASE_SLOT
+    last_slot = min((hours[1] + 1) * 3600 // BASE_SLOT,
+                    index.sketches.shape[2])
+    if last_slot <= first_slot:
+        return counts
+
+    slot_buckets = np.arange(first_slot, last_slot) * BASE_SLOT // \
+        (time_div * 60)
+    starts = np.flatnonzero(np.r_[True, slot_buckets[1:] != slot_buckets[:-1]])
+    for it, row in enumerate(rows):
+        merged = np.maximum.reduceat(
+            index.sketches[row, lo:hi, first_slot:last_slot], starts, axis=1)
+        counts[it, slot_buckets[starts]] = sketches.estimate(merged).sum(
+            axis=0)
+    return counts
+
+
+def query_counts(index, historic, boroughs, hours, start_date, end_date,
+                 time_div, approximate=False):
+    """Unique vehicle counts per borough and time bucket of the day, summed
+    over the days in a date and hour range, and which routes of the index
+    were seen in that range.
+
+    Matches filtering the raw pings on timestamp and hour, resampling and
+    summing the counts of each bucket over days, for every borough. Whole
+    days come from the index (from its sketches if approximate), the days
+    only partially covered from the historic store."""
+    start = pd.to_datetime(start_date).value
+    end = pd.to_datetime(end_date).value
+    n_days = index.cumulative_routes.shape[0] - 1
+    n_buckets = SECONDS_PER_DAY // (time_div * 60)
+    counts = np.zeros((len(boroughs), n_buckets), dtype=np.int64)
+    seen = np.zeros(len(index.route_names), dtype=bool)
+
+    # days completely inside the date range come from the index
+    lo = int(np.clip(-(-start // NS_PER_DAY) - index.first_day, 0, n_days))
+    hi = int(np.clip(end // NS_PER_DAY - index.first_day, 0, n_days))
+    if hi > lo:
+        rows = [index.boroughs.index(b) for b in boroughs]
+        if approximate:
+            counts += np.rint(sketch_counts(index, rows, lo, hi, hours,
+                                            time_div)).astype(np.int64)
+        else:
+            parts = bucket_parts(time_div, hours)
+            cumulative = index.cumulative_counts[time_div]
+            day_sums = cumulative[rows, hi] - cumulative[rows, lo]
+            counts += np.where(parts >= 0, day_sums[:, np.arange(n_buckets),
+                                                    parts.clip(0)], 0)
+        # routes seen in the rectangle of days and hours
+        first, last = min(hours[0], 24), min(hours[1] + 1, 24)
+        route_sums = index.cumulative_routes
+        seen |= (route_sums[hi, last] - route_sums[lo, last] -
+                 route_sums[hi, first] + route_sums[lo, first]) > 0
+        # both ends included, the pings are in whole seconds
+        edges = [(start, (index.first_day + lo) * NS_PER_DAY - NS_PER_SECOND),
+                 ((index.first_day + hi) * NS_PER_DAY, end)]
+    else:
+        edges = [(start, end)]
+
+    # the remaining partial days are counted from their pings, which only
+    # loads the days at the ends of the range, for all boroughs in one pass
+    route_index = pd.Index(index.route_names)
+    for left, right in edges:
+        if right < left:
+            continue
+        ddf = historic.select(pd.Timestamp(left), pd.Timestamp(right), hours)
+        if ddf.empty:
+            continue
+        routes = route_index.get_indexer(pd.unique(ddf.route_id))
+        seen[routes[routes >= 0]] = True
+
+        seconds = ping_seconds(ddf)
+        days = seconds // SECONDS_PER_DAY
+        days = days - days.min()
+        buckets = seconds % SECONDS_PER_DAY // (time_div * 60)
+        cells = days * n_buckets + buckets
+        n_cells = (days.max() + 1) * n_buckets
+        row_it, borough_it = np.nonzero(borough_members(borough_codes(ddf),
+                                                        boroughs))
+        counts += count_unique(
+            borough_it * n_cells + cells[row_it],
+            pd.factorize(ddf.vehicle_id)[0][row_it],
+            len(boroughs) * n_cells).reshape(
+                len(boroughs), -1, n_buckets).sum(axis=1)
+
+    return counts, seen
+
+
+def borough_routes(index, seen, borough):
+    """Names of the routes seen that run in a borough ("All" for every)"""
+    return index.route_names[seen & index.route_flags[borough]]
+
+
+def borough_unique_counts(ddf, boroughs, keep=None):
+    """Unique vehicles and number of rows in every borough ("All" for every
+    row) in one pass, optionally only over the rows kept"""
+    bits = borough_codes(ddf)
+    vehicles = pd.factorize(ddf.vehicle_id)[0]
+    if keep is not None:
+        bits, vehicles = bits[keep], vehicles[keep]
+    members = borough_members(bits, boroughs)
+    row_it, borough_it = np.nonzero(members)
+    return (count_unique(borough_it, vehicles[row_it], len(boroughs)),
+            members.sum(axis=0))
@@ -1,16 +1,31 @@
+import os
+
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+import flask
 
-import base64
-# import matplotlib
-import datetime
+import copy
+import functools
 import json  # needed implicitly
-from matplotlib import cm
+import logging
+import threading
+
 import numpy as np
 import pandas as pd
 import plotly.graph_objs as go
-import requests
+
+import aggregates
+import cache
+import figures
+import grid
+import live
+import metrics
+import pool
+import precompute
+import sketches
+import store
+from boroughs import dic_borough, inv_dic_borough
 
 
 # style sheet and dictionary for style elements
@@ -19,39 +34,23 @@ colors = {'background': '#5369CA',
           'header': "#FFFFFF",
           'text': '#000000'}
 
+logger = logging.getLogger(__name__)
+
 # start application
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 server = app.server
 
-# dictionaries translating bus route_id acronyms to boroughs
-dic_borough = {"M": "Manhattan", "Bx": "Bronx", "B": "Brooklyn", "Q": "Queens",
-               "S": "Staten Island", "SIM": "Express to Manhattan"}
-inv_dic_borough = {v: k for k, v in dic_borough.items()}
-
+# "client" sends the whole heatmap cube once and the slider only redraws it
+# in the browser, "server" builds the heatmap of every slider position here
+HEATMAP_MODE = os.environ.get("HEATMAP_MODE", "client")
+# "approximate" counts the whole days of historic data from HyperLogLog
+# sketches (see sketches.py) instead of the exact counts
+APPROXIMATE = os.environ.get("COUNT_MODE", "exact") == "approximate"
 
-def create_boroughs(ddf):
-    """Add boolean columns for whether a route is in a specific borough"""
-    new = ddf.copy()
-    new["M"] = new.route_id.str.contains('M', regex=False)
-    new["S"] = new.route_id.str.contains(r'^S\d+')
-    new["Bx"] = new.route_id.str.contains('Bx', regex=False)
-    new["Q"] = new.route_id.str.contains('Q', regex=False)
-    new["B"] = new.route_id.str.contains(r"^B([A-Z]|\d)")
-    new["SIM"] = new.route_id.str.contains(r"^SIM")
-    return new
+# opened in the background, so that the workers serve while it loads
+historic = store.HistoricLoader()
 
-# have to load data first for setting ranges, etc. in buttons
-df = pd.read_csv('data.csv', index_col=0, parse_dates=True)
-# add borough
-df = create_boroughs(df)
-# reformat timestamp
-timestamp = "%Y-%m-%d %H:%M:%S"
-df["timestamp"] = pd.to_datetime(df["timestamp"], format=timestamp)
-df["hour"] = df["timestamp"].dt.hour
-
-encoded_image = base64.b64encode(open("openstreetmap_nyc.png", 'rb').read())
-
-app.layout = html.Div([
+layout = html.Div([
 
     # creating sidebar
     html.Div([
@@ -75,7 +74,7 @@ app.layout = html.Div([
                                    "color": colors['header'], 'width': '80%',
                                    "display": "inline-block"}),
 
-                html.P("NOTE: Refreshing takes several seconds.",
+                html.P("NOTE: Live data is fetched in the background.",
                        style={"font-size": '10', 'padding-top': '10px'})],
             style={'padding-left': '20px', 'width': '90%'}
         ),
@@ -83,16 +82,11 @@ app.layout = html.Div([
         html.H3("Controls for historic data",
                 style={'padding-top': '40px', 'padding-left': '20px'}),
         # ---- date range for historic data ----
-        html.Div(
-            dcc.DatePickerRange(
-                id='date-range',
-                min_date_allowed=df.timestamp.min(),
-                max_date_allowed=df.timestamp.max(),
-                initial_visible_month=df.timestamp.min(),
-                start_date=df.timestamp.min(),
-                end_date=df.timestamp.max()
-            ), style={'padding-left': '20px', 'width': '90%'}
-        ),
+        # the dates of the historic data are filled in by serve_layout, or
+        # by fill_dates once loaded if the page was served before
+        html.Div([dcc.DatePickerRange(id='date-range'),
+                  dcc.Interval(id='historic-poll', interval=1000)],
+                 style={'padding-left': '20px', 'width': '90%'}),
 
         # ---- time range for historic data ----
         html.H5("Hour range",
@@ -147,7 +141,8 @@ app.layout = html.Div([
                      style={"font-size": '15', 'padding-left': '30px'}),
 
               html.Div([
-                  html.Div([dcc.Graph(id='graph-1')],
+                  html.Div([dcc.Graph(id='graph-1'),
+                            dcc.Store(id='heatmap-cube')],
                            style={'textAlign': 'center', 'padding-top':
                                   '30px'}),
 
@@ -156,7 +151,18 @@ app.layout = html.Div([
                                       max=24,
                                       value=0,
                                       marks={str(h): {'label': "%s:00" % h} for h in np.arange(0, 24, 1)}),
-                           style={'textAlign': 'center', 'width': "85%", 'padding-bottom': "60px"})],
+                           style={'textAlign': 'center', 'width': "85%", 'padding-bottom': "60px"}),
+
+                  html.Div(dcc.RadioItems(
+                      id='heatmap-resolution',
+                      options=[{'label': "%s (%i x %i)" % (r, n_lats, n_lons),
+                                'value': r}
+                               for r, (n_lats, n_lons)
+                               in grid.RESOLUTIONS.items()],
+                      value=grid.DEFAULT_RESOLUTION,
+                      labelStyle={'display': 'inline-block',
+                                  'padding-right': '20px'}),
+                           style={'textAlign': 'center', 'padding-bottom': "60px"})],
                        style={'textAlign': 'center'})
               ],
              style={'width': "95%", 'display': 'inline-block',
@@ -165,58 +171,84 @@ app.layout = html.Div([
              )
 ])
 
-# ---- used to load  and process live data ----
 
+# properties of the date picker set to the dates of the historic data
+DATE_PROPS = ['min_date_allowed', 'max_date_allowed', 'initial_visible_month',
+              'start_date', 'end_date']
 
-def nyc_current():
-    """Request latests live feed"""
 
-    def _flatten_dict(root_key, nested_dict, flattened_dict):
-        """Flatten json file from MTA Bus Time API"""
-        for key, value in nested_dict.items():
-            next_key = root_key + "_" + key if root_key != "" else key
-            if isinstance(value, dict):
-                _flatten_dict(next_key, value, flattened_dict)
-            else:
-                flattened_dict[next_key] = value
-        return flattened_dict
+def historic_dates():
+    """Values of DATE_PROPS, once the historic data is loaded"""
+    return [historic.first, historic.last, historic.first, historic.first,
+            historic.last]
+
+
+def serve_layout():
+    """Layout of a page load, with the date range of the historic data if
+    it is loaded already. The shared layout itself is never changed"""
+    if not historic.ready:
+        return layout
+    page = copy.deepcopy(layout)
+    for prop, value in zip(DATE_PROPS, historic_dates()):
+        setattr(page['date-range'], prop, value)
+    page['historic-poll'].disabled = True
+    return page
 
-    params = {"key": "19faff8a-c061-4c7e-8dc4-63685ab24123",
-              "MaximumStopVisits": 2}
 
-    resp = requests.get("http://bustime.mta.info/api/siri/vehicle-monitoring.json",
-                        params=params).json()
-    info = resp['Siri']['ServiceDelivery'][
-        'VehicleMonitoringDelivery'][0]['VehicleActivity']
-    return pd.DataFrame([_flatten_dict('', i, {}) for i in info])
+# the callbacks are validated against the layout without dates
+app.validation_layout = layout
+app.layout = serve_layout
+
+
+@app.callback(
+    [dash.dependencies.Output('date-range', prop) for prop in DATE_PROPS] +
+    [dash.dependencies.Output('historic-poll', 'disabled')],
+    [dash.dependencies.Input('historic-poll', 'n_intervals')],
+    [dash.dependencies.State('date-range', 'start_date')])
+def fill_dates(n_intervals, start_date):
+    """Fill in the dates of a page served before the historic data was
+    loaded, then stop polling"""
+    if start_date is not None or not historic.ready:
+        raise dash.exceptions.PreventUpdate
+    return historic_dates() + [True]
+
+# ---- used to load  and process live data ----
+
+# pings of the live snapshots of the last day, and the latest live data,
+# only parsed again after a refresh
+live_history = live.LiveHistory("live_history.npz")
+live_snapshot = live.LiveSnapshot("live.csv", history=live_history)
+
+
+# fetches the live feed in the background, if enabled
+poller = live.SiriPoller(live_snapshot)
+if poller.interval > 0:
+    poller.start()
+
+# heavy callbacks are computed on a bounded pool of threads
+callback_pool = pool.CallbackPool()
 
 
 @app.callback(
     dash.dependencies.Output('button-clicks', 'children'),
     [dash.dependencies.Input('button', 'n_clicks')])
+@metrics.instrument
+@callback_pool.offload(timeout=60)
 def clicks(n_clicks):
     """Update live data when button clicked"""
 
     if n_clicks is not None:
-        current = nyc_current()
-        sel_curr = current[['RecordedAtTime',
-                            'MonitoredVehicleJourney_VehicleRef',
-                            "MonitoredVehicleJourney_PublishedLineName",
-                            'MonitoredVehicleJourney_VehicleLocation_Latitude',
-                            'MonitoredVehicleJourney_VehicleLocation_Longitude']]
-        sel_curr = sel_curr.rename(index=str,
-                                   columns={
-                                       'RecordedAtTime': "timestamp",
-                                       'MonitoredVehicleJourney_VehicleRef': "vehicle_id",
-                                       "MonitoredVehicleJourney_PublishedLineName": "route_id",
-                                       'MonitoredVehicleJourney_VehicleLocation_Latitude': "latitude",
-                                       'MonitoredVehicleJourney_VehicleLocation_Longitude': "longitude"})
-        # put into timestamp into EST
-        sel_curr["timestamp"] = pd.to_datetime(sel_curr["timestamp"]) - \
-            pd.Timedelta(hours=4)
-        # get boolean columns for boroughs
-        sel_curr = create_boroughs(sel_curr)
-        sel_curr.to_csv("live.csv")
+        if poller.running:
+            # only pick up the latest snapshot published by the poller
+            live_snapshot.refresh()
+        else:
+            try:
+                poller.poll_once()
+            except Exception as err:
+                # keep showing the last snapshot rather than failing
+                logger.warning("Refreshing live data failed: %s", err)
+                return "Could not refresh live data, using the last " \
+                    "saved version."
         return 'Live data has been refreshed {} times'.format(n_clicks)
     else:
         return "Using last saved version of live data."
@@ -240,8 +272,8 @@ def match_routes(live_ddf, old_routes):
     """Match routes of live data with historic, as routes may have been
     added since then."""
 
-    sel_mask = (live_ddf.route_id.isin(old_routes))
-    sel_live = live_ddf[sel_mask].copy()
+    # boolean indexing already returns a new frame, leaving live_ddf untouched
+    sel_live = live_ddf[live_ddf.route_id.isin(old_routes)]
 
     return aggregate_live(sel_live)
 
@@ -250,46 +282,96 @@ def match_routes(live_ddf, old_routes):
 
 
 def get_selected_data(ddf, hours, start_date, end_date, time_div):
-    """Apply start & end date and hour criteria. Returns selected dataframe"""
-    sel_mask = (ddf["timestamp"] >= pd.to_datetime(start_date)) & \
-        (ddf["timestamp"] <= pd.to_datetime(end_date)) & \
-        (ddf["hour"] >= hours[0]) & (ddf["hour"] <= hours[1])
-    sel_data = ddf[sel_mask].copy()
+    """Apply start & end date and hour criteria to the historic store.
+    Returns selected dataframe"""
+    # only the days within the dates are loaded, sliced to the hours
+    sel_data = ddf.select(start_date, end_date, hours)
 
     routes = sel_data["route_id"].unique()
 
     return sel_data, routes
 
 
+def counts_frame(counts):
+    """Keep the time buckets with vehicles. Labels for the buckets are only
+    made when plotting (see aggregates.bucket_labels)"""
+    buckets = np.flatnonzero(counts > 0)
+    return pd.DataFrame({"bucket": buckets, "vehicle_count": counts[buckets]})
+
+
 def get_vehicle_counts(ddf, hours, start_date, end_date, time_div):
     """Obtain vehicle counts from historic data in specified time intervals"""
     sel_data, routes = get_selected_data(ddf, hours, start_date, end_date,
                                          time_div)
 
-    # want to only count unique vehicle ids in the time window with
-    sampled = sel_data.resample("%sMin" % time_div,
-                                on="timestamp").agg({"vehicle_id": "nunique"})
-    # easiest way to return to a pandas dataframe
-    sampled = sampled.reset_index()
+    # unique vehicle ids per day and time bucket, summed over days
+    counts = aggregates.bucket_counts(sel_data, time_div)
+
+    return counts_frame(counts), routes
+
+
+@cache.memoize_once
+def precomputed():
+    """Aggregates written by precompute.py for the current store, or None"""
+    precision = sketches.PRECISION if APPROXIMATE else None
+    return precompute.load_artifacts(historic, precision=precision)
+
+
+@cache.memoize_once
+def count_index():
+    """Load the precomputed vehicle count index of the historic data, or
+    build it on first use"""
+    if precomputed() is not None:
+        return precomputed().index
+    precision = sketches.PRECISION if APPROXIMATE else None
+    return precompute.build_index(historic, precision)
 
-    # create hour for groupby
-    sampled["hhmmss"] = sampled["timestamp"].apply(lambda x: x.time())
-    sampled["hh"] = sampled["timestamp"].apply(lambda x: "%i:00" % (x.hour))
-    data = sampled.groupby("hhmmss", as_index=False).agg({"vehicle_id": 'sum',
-                                                          "hh": 'first'})
-    data = data.rename(index=str, columns={"vehicle_id": "vehicle_count"})
-    data["timestamp"] = data["hhmmss"].apply(lambda x: "2015-09-12 %s" % x)
-    data = data.sort_values("timestamp")
-    data = data[data.vehicle_count > 0]
 
-    return data, routes
+def count_error():
+    """Label of the relative error of approximate counts, empty if exact"""
+    if not APPROXIMATE:
+        return ""
+    return " (approx. \u00b1%.1f%%)" % (100 * sketches.relative_error())
+
+
+def get_indexed_counts(borough, hours, start_date, end_date, time_div):
+    """Obtain the same vehicle counts as get_vehicle_counts on the historic
+    data of a borough ("All" for every borough) from the count index"""
+    index = count_index()
+    counts, seen = aggregates.query_counts(index, historic, [borough], hours,
+                                           start_date, end_date, time_div,
+                                           approximate=APPROXIMATE)
+
+    return counts_frame(counts[0]), aggregates.borough_routes(index, seen,
+                                                              borough)
 
 
 # ---- used to generate or directly modify plots ----
 
+# figures of the historic panels for the most recent filter selections
+figure_cache = cache.FigureCache(maxsize=128, version=live_snapshot.refresh)
+
+
+@server.route("/cache-stats")
+def cache_stats():
+    """Report hits and misses of the figure cache"""
+    return flask.jsonify(dict(figure_cache.stats(),
+                              historic=historic.stats(),
+                              pool=callback_pool.stats()))
+
+
+@server.route("/metrics")
+def callback_metrics():
+    """Report latency histograms of the callbacks, to local requests only"""
+    if flask.request.remote_addr not in ("127.0.0.1", "::1"):
+        flask.abort(403)
+    return flask.jsonify(metrics.metrics.report())
+
+
 @app.callback(
     dash.dependencies.Output("show-me", "step"),
     [dash.dependencies.Input("time-div", 'value')])
+@metrics.instrument
 def redo_slider(time_div):
     """Change size of step in show-me slider"""
     return time_div / 60
@@ -304,14 +386,13 @@ def redo_slider(time_div):
      dash.dependencies.Input("time-div", 'value'),
      dash.dependencies.Input("route-match", "value"),
      dash.dependencies.Input('violin-plot', 'hoverData')])
+@metrics.instrument
 def daily_graph(d, hours, start_date, end_date, time_div, route_match, borough):
     """Plot count of historic and live data as a function of time"""
 
-    # --- load datasets ----
-    # historic data
-    hist_df = df.copy()
-    # live data
-    live_df = pd.read_csv("live.csv", index_col=0, parse_dates=True)
+    # no dates until the historic data is loaded, see fill_dates
+    if start_date is None or end_date is None:
+        raise dash.exceptions.PreventUpdate
 
     # --- obtain hover item from violin plot---
     if borough is not None:
@@ -319,13 +400,27 @@ def daily_graph(d, hours, start_date, end_date, time_div, route_match, borough):
     else:
         key = "All"
 
+    return daily_figure(hours, start_date, end_date, time_div, route_match,
+                        key)
+
+
+@figure_cache.memoize
+@callback_pool.offload()
+def daily_figure(hours, start_date, end_date, time_div, route_match, key):
+    """Figure of daily_graph for the borough hovered over (or "All")"""
+
+    # --- load datasets ----
+    # live data
+    live_df = live_snapshot.frame()
+    metrics.lap("live")
+
     # if not all, then need to select specific borough to plot
     hist_plot = False
     live_plot = False
 
     if key != "All":
-        if any(hist_df[inv_dic_borough[key]]):
-            hist_df = hist_df[hist_df[inv_dic_borough[key]]]
+        hist_borough = inv_dic_borough[key]
+        if any(count_index().route_flags[hist_borough]):
             hist_plot = True
         if any(live_df[inv_dic_borough[key]]):
             live_df = live_df[live_df[inv_dic_borough[key]]]
@@ -333,6 +428,7 @@ def daily_graph(d, hours, start_date, end_date, time_div, route_match, borough):
         title = key
     else:
         title = "all boroughs of NYC"
+        hist_borough = "All"
         hist_plot = True
         live_plot = True
 
@@ -341,16 +437,27 @@ def daily_graph(d, hours, start_date, end_date, time_div, route_match, borough):
     # ---- perform time selection on historic data and plot----
     hist_routes = []
     if hist_plot:
-        hist_df, hist_routes = get_vehicle_counts(hist_df, hours, start_date,
-                                                  end_date, time_div)
+        hist_df, hist_routes = get_indexed_counts(hist_borough, hours,
+                                                  start_date, end_date,
+                                                  time_div)
         days = (pd.to_datetime(end_date) - pd.to_datetime(start_date)).days
-
-        hist_trace = go.Scatter(x=hist_df["timestamp"].astype(str),
-                                y=hist_df["vehicle_count"] / days,
+        metrics.lap("query")
+        metrics.note("days", days)
+        metrics.note("buckets", len(hist_df))
+        metrics.note("routes", len(hist_routes))
+
+        labels = aggregates.bucket_labels(time_div)
+        x, y = figures.decimate(labels[hist_df["bucket"].values],
+                                figures.compact(hist_df["vehicle_count"] /
+                                                days))
+        hist_trace = go.Scatter(x=x,
+                                y=y,
                                 mode='markers+lines',
-                                name='historic data: %i min' % time_div,
+                                name='historic data: %i min%s' % (
+                                    time_div, count_error()),
                                 marker={'size': 8})
         traces.append(hist_trace)
+        metrics.lap("figure")
 
     # ---- live data match route data of historic (if specified) and plot ----
     if live_plot:
@@ -367,6 +474,26 @@ def daily_graph(d, hours, start_date, end_date, time_div, route_match, borough):
 
         traces.append(live_trace)
 
+        # live data of the previous snapshots, folded onto the time of day
+        starts, live_counts = live_history.counts(time_div, hist_borough)
+        if len(starts) > 0:
+            buckets = starts % aggregates.SECONDS_PER_DAY // (time_div * 60)
+            # a later day replaces an earlier one at the same time of day
+            buckets, latest = np.unique(buckets[::-1], return_index=True)
+            labels = aggregates.bucket_labels(time_div)
+            x, y = figures.decimate(labels[buckets],
+                                    live_counts[::-1][latest])
+            history_trace = go.Scatter(
+                x=x,
+                y=y,
+                mode='lines',
+                # the hours actually kept, e.g. shortly after a first start
+                name='live data: last %g h' % round(
+                    live_history.span() / 3600, 1))
+            traces.append(history_trace)
+        metrics.lap("live")
+        metrics.note("live_rows", len(live_df))
+
     layout = go.Layout(title="Daily activity of vehicles in %s" % title,
                        titlefont=dict(size=30),
                        height=400,
@@ -381,6 +508,7 @@ def daily_graph(d, hours, start_date, end_date, time_div, route_match, borough):
                                   tickfont=dict(size=15)),
                        legend=dict(font=dict(size=15)))
 
+    metrics.lap("figure")
     return {"data": traces, 'layout': layout,
             'style': {'width': '40%', 'padding-left': '25px',
                       'display': 'inline-block'}}
@@ -394,104 +522,87 @@ def daily_graph(d, hours, start_date, end_date, time_div, route_match, borough):
      dash.dependencies.Input("date-range", 'end_date'),
      dash.dependencies.Input("time-div", 'value'),
      dash.dependencies.Input("route-match", "value")])
+@metrics.instrument
 def violin_plot(dummy, hours, start_date, end_date, time_div, route_match):
     """Draw violin plot with different boroughs"""
+    if start_date is None or end_date is None:
+        raise dash.exceptions.PreventUpdate
+    return violin_figure(hours, start_date, end_date, time_div, route_match)
 
-    # load historical data and add borough booleans
-    hist_df, hist_routes = get_selected_data(df, hours, start_date, end_date,
-                                             time_div)
-    days = (pd.to_datetime(end_date) - pd.to_datetime(start_date)).days
 
-    # load live data and add borough booleans
-    live_df = pd.read_csv("live.csv", index_col=0, parse_dates=True)
+@figure_cache.memoize
+@callback_pool.offload()
+def violin_figure(hours, start_date, end_date, time_div, route_match):
+    """Figure of violin_plot, which does not depend on the button clicks"""
 
-    # get counts for all historical data
-    all_df, all_routes = get_vehicle_counts(hist_df, hours, start_date,
-                                            end_date, time_div)
-    all_counts = all_df.vehicle_count / days
+    days = (pd.to_datetime(end_date) - pd.to_datetime(start_date)).days
 
+    # load live data and add borough booleans
+    live_df = live_snapshot.frame()
+    metrics.lap("live")
+
+    # get counts of historical data for all boroughs at once
+    keys = ["All"] + list(dic_borough)
+    index = count_index()
+    hist_counts, seen = aggregates.query_counts(index, historic, keys, hours,
+                                                start_date, end_date,
+                                                time_div,
+                                                approximate=APPROXIMATE)
+    all_routes = aggregates.borough_routes(index, seen, "All")
+    metrics.lap("query")
+    metrics.note("days", days)
+    metrics.note("routes", len(all_routes))
+
+    # live data of every borough at once, within the same routes and not
+    live_counts, live_rows = aggregates.borough_unique_counts(live_df, keys)
     if route_match == 1:
-        _, count_live, _ = match_routes(live_df, all_routes)
-    else:
-        _, count_live, _ = aggregate_live(live_df)
-
-    #  create point and violin across all boroughs
-    traces = [{"type": 'violin',
-               "x": ["All"] * all_counts.shape[0],
-               "y": all_counts,
-               "bandwidth": 20,
-               'name': "All",
-               'legendgroup':"All",
-               "showlegend": True,
-               "box": {"visible": True},
-               "meanline": {"visible": True}},
-
-              go.Scatter(x=["All"],
-                         y=[count_live],
-                         mode='markers',
-                         name='All',
-                         legendgroup="All",
-                         showlegend=False,
-                         marker={'size': 8})
-              ]
-
-    for it, col in enumerate(dic_borough.keys()):
-        if any(hist_df[col]):
-            # extracting items within certain borough
-            t_hist_df = hist_df[hist_df[col]]
-            # getting counts with specified time division and criteria
-            temp_df, temp_routes = get_vehicle_counts(t_hist_df, hours,
-                                                      start_date, end_date,
-                                                      time_div)
-
-            counts = temp_df.vehicle_count / days
+        matched_counts, _ = aggregates.borough_unique_counts(
+            live_df, keys, keep=live_df.route_id.isin(all_routes).values)
+    metrics.lap("live")
+    metrics.note("live_rows", len(live_df))
+
+    traces = []
+    for it, col in enumerate(keys):
+        name = dic_borough.get(col, col)
+        # any routes of the borough within the selection (always for all)
+        hist_plot = col == "All" or any(seen & index.route_flags[col])
+
+        if hist_plot:
+            counts = figures.compact(hist_counts[it][hist_counts[it] > 0] /
+                                     days)
             violin = {"type": 'violin',
-                      "x": [dic_borough[col]] * counts.shape[0],
+                      "x": [name] * counts.shape[0],
                       "y": counts,
                       "bandwidth": 20,
-                      'name': dic_borough[col],
-                      'legendgroup': dic_borough[col],
+                      'name': name,
+                      'legendgroup': name,
                       "showlegend": True,
                       "box": {"visible": True},
                       "meanline": {"visible": True}}
             traces.append(violin)
 
+        if col == "All" or live_rows[it] > 0:
             # want to match routes in case of live data so no discrepancy's
-            # other than increase service within those routes
-            if any(live_df[col]):
-                # extracting items within certain borough
-                t_live_df = live_df[live_df[col]]
-                # ensure in same routes
-                if route_match == 1:
-                    _, count, _ = match_routes(t_live_df, temp_routes)
-                else:
-                    _, count, _ = aggregate_live(t_live_df)
-
-                point = go.Scatter(x=[dic_borough[col]],
-                                   y=[count],
-                                   mode='markers',
-                                   name=dic_borough[col],
-                                   showlegend=False,
-                                   legendgroup=dic_borough[col],
-                                   marker={'size': 8})
-                traces.append(point)
-
-        # historic data may not include some boroughs that the live data does
-        else:
-            if any(live_df[col]):
-                # extracting items within certain borough
-                t_live_df = live_df[live_df[col]]
-                _, count, _ = aggregate_live(t_live_df)
-
-                point = go.Scatter(x=[dic_borough[col]],
-                                   y=[count],
-                                   mode='markers',
-                                   name=dic_borough[col],
-                                   legendgroup=dic_borough[col],
-                                   marker={'size': 8})
-                traces.append(point)
-
-    layout = go.Layout(title="Number of active vehicles per borough",
+            # other than increase service within those routes, unless the
+            # historic data does not include the borough
+            if route_match == 1 and hist_plot:
+                count = matched_counts[it]
+            else:
+                count = live_counts[it]
+
+            # legend entry comes from the violin if there is one
+            legend = {"showlegend": False} if hist_plot else {}
+            point = go.Scatter(x=[name],
+                               y=[count],
+                               mode='markers',
+                               name=name,
+                               legendgroup=name,
+                               marker={'size': 8},
+                               **legend)
+            traces.append(point)
+
+    layout = go.Layout(title="Number of active vehicles per borough" +
+                       count_error(),
                        titlefont=dict(size=30),
                        height=400,
                        xaxis=dict(title='Borough',
@@ -504,119 +615,142 @@ def violin_plot(dummy, hours, start_date, end_date, time_div, route_match):
                                   tickfont=dict(size=15)),
                        legend=dict(font=dict(size=15)),
                        hovermode='closest')
+    metrics.lap("figure")
     return {"data": traces, "layout": layout}
 
 
-def matplotlib_to_plotly(cmap, pl_entries):
-    """Convert matplotlib colormap to plotly version"""
-    h = 1.0 / (pl_entries - 1)
-    pl_colorscale = []
-
-    for k in range(pl_entries):
-        C = list(map(np.uint8, np.array(cmap(k * h)[:3]) * 255))
-        pl_colorscale.append([k * h, 'rgb' + str((C[0], C[1], C[2]))])
-
-    return pl_colorscale
-
-
-def location_data():
-    """Load and processs location data"""
-
-    # --- load datasets ----
-    # historic data
-    hist_df = df.copy()
-
-    hist = hist_df.set_index("timestamp")
-
-    # create binned versions of latitude and longitude
-    hist["lats"] = pd.cut(hist.latitude, 15)
-    hist["longs"] = pd.cut(hist.longitude, 10)
-
-    # use grouper with timestamp index instead of resampler as can
-    # couple with latitutde and longitude from before
-    # get count of vehicles per day
-    group = hist.groupby([pd.Grouper(freq='15Min'), "lats", "longs"]).agg(
-        {"vehicle_id": "nunique"})
-    group = group.reset_index()
-
-    group["hhmmss"] = group["timestamp"].apply(lambda x: x.time())
-    # now group by time and take mean of vehicle count across days
-    group_hh = group.groupby(["hhmmss", "lats", "longs"], as_index=False).agg(
-        {"vehicle_id": 'mean'})
-    # get midpoints of lat and longs for heatmap
-    group_hh["lats"] = group_hh.lats.apply(lambda x: x.mid)
-    group_hh["longs"] = group_hh.longs.apply(lambda x: x.mid)
-
-    # creating easy objects to access for creating animated heatmap
-    groups = group_hh.groupby("hhmmss")
-
-    return groups, group_hh.vehicle_id.max()
-
-
-def location_trace(value):
-    group, max_val = location_data()
+@functools.lru_cache(maxsize=None)
+def heatmap_colorscale():
+    """Viridis colorscale of the heatmap, prebuilt in colorscales.json"""
+    viridis = list(figures.colorscale('viridis'))
+    # reset last one to be transparent
+    viridis[-1] = [1.0, 'rgba(68, 1, 84, 0)']
+    return viridis
+
+
+@cache.memoize_once
+@callback_pool.offload(timeout=120)
+def location_data(resolution=grid.DEFAULT_RESOLUTION):
+    """Load the precomputed heatmap cube of the historic data at a
+    resolution of the grid, or build it on first use"""
+    if precomputed() is not None:
+        return precomputed().cubes[resolution]
+    return precompute.build_cube(historic, resolution)
+
+
+def heatmap_trace(cube):
+    """Heatmap trace without its z values, shared by both heatmap modes"""
+    return dict(type='heatmap',
+                x=figures.compact(cube.lon_mids, 4),
+                y=figures.compact(cube.lat_mids, 4),
+                zmin=2,
+                zmax=figures.compact(cube.counts.max()),
+                opacity=0.5,
+                zsmooth='best',
+                colorbar=dict(thickness=20, ticklen=4),
+                colorscale=heatmap_colorscale(),
+                reversescale=True
+                )
+
+
+def location_trace(value, resolution=grid.DEFAULT_RESOLUTION):
+    cube = location_data(resolution)
+
+    slot = aggregates.heatmap_slot(cube, float(value))
+    if slot is None:
+        return []
 
-    get_time = value.split(".")
-    if len(get_time) == 1:
-        key = datetime.time(int(get_time[0]), 0)
-    else:
-        key = datetime.time(int(get_time[0]), int(
-            float("0." + get_time[1]) * 60))
+    data_plot = [dict(heatmap_trace(cube), z=figures.compact(cube.counts[slot]))]
+    return data_plot
+
+
+def heatmap_layout():
+    return dict(title="Daily activity of vehicles",
+                titlefont=dict(size=30),
+                xaxis=dict(range=[grid.WEST, grid.EAST], showticklabels=False),
+                yaxis=dict(range=[grid.SOUTH, grid.NORTH],
+                           showticklabels=False),
+                images=[dict(
+                    # served once from assets/ and cached by the browser
+                    source=app.get_asset_url("openstreetmap_nyc.png"),
+                    xref="x",
+                    yref="y",
+                    x=grid.WEST,
+                    y=grid.NORTH,
+                    sizex=grid.EAST - grid.WEST,
+                    sizey=grid.NORTH - grid.SOUTH,
+                    sizing="stretch",
+                    layer="below")],
+                hovermode='closest',
+                showlegend=False,
+                width=1156,
+                height=851
+                )
+
+
+@cache.memoize_once
+def heatmap_payload(resolution=grid.DEFAULT_RESOLUTION):
+    """Whole heatmap cube with its trace and layout, sent to the browser once
+    per resolution so that moving the slider is handled by assets/heatmap.js"""
+    cube = location_data(resolution)
+    return {"slot": cube.slot,
+            "counts": figures.pack_uint16(cube.counts),
+            "trace": heatmap_trace(cube),
+            "layout": heatmap_layout()}
+
+
+if HEATMAP_MODE == "client":
+    @app.callback(
+        dash.dependencies.Output('heatmap-cube', 'data'),
+        [dash.dependencies.Input('heatmap-resolution', 'value')])
+    @metrics.instrument
+    def load_heatmap(resolution):
+        """Fill the heatmap store once per page load and resolution"""
+        return heatmap_payload(resolution)
+
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace='heatmap',
+                                             function_name='frame'),
+        dash.dependencies.Output('graph-1', 'figure'),
+        [dash.dependencies.Input('show-me', 'value'),
+         dash.dependencies.Input('heatmap-cube', 'data')])
+else:
+    @app.callback(
+        dash.dependencies.Output('graph-1', 'figure'),
+        [dash.dependencies.Input('show-me', 'value'),
+         dash.dependencies.Input('heatmap-resolution', 'value')])
+    @metrics.instrument
+    def update_graph_1(value, resolution):
+        return {'data': location_trace(str(value), resolution),
+                'layout': heatmap_layout()}
+
+
+# ---- warm up ----
+
+# set WARM_UP=0 to build the aggregates on first use only
+WARM_UP = os.environ.get("WARM_UP", "1") != "0"
+
+
+def warm_up():
+    """Load the historic data and the aggregates in the background, before
+    the first callbacks need them"""
+    historic.wait()
+    count_index()
+    # with the arguments of the requests, to fill the same cache entries
     try:
-        sel = group.get_group(key)
-
-        # getting color map
-        viridis_cmap = cm.get_cmap('viridis')
-        viridis = matplotlib_to_plotly(viridis_cmap, 255)
-        # reset last one to be transparent
-        viridis[-1] = [1.0, 'rgba(68, 1, 84, 0)']
-
-        data_plot = [dict(type='heatmap',
-                          x=sel.longs,
-                          y=sel.lats,
-                          z=sel.vehicle_id,
-                          zmin=2,
-                          zmax=max_val,
-                          opacity=0.5,
-                          zsmooth='best',
-                          colorbar=dict(thickness=20, ticklen=4),
-                          colorscale=viridis,
-                          reversescale=True
-                          )]
-        return data_plot
-
-    except:
-
-        return []
+        if HEATMAP_MODE == "client":
+            heatmap_payload(grid.DEFAULT_RESOLUTION)
+        else:
+            location_data(grid.DEFAULT_RESOLUTION)
+    except dash.exceptions.PreventUpdate:
+        # took longer than the pool waits for it, the first request waits
+        # for the computation still in flight
+        pass
 
 
-@app.callback(
-    dash.dependencies.Output('graph-1', 'figure'),
-    [dash.dependencies.Input('show-me', 'value')])
-def update_graph_1(value):
-
-    layout = dict(title="Daily activity of vehicles",
-                  titlefont=dict(size=30),
-                  xaxis=dict(range=[-74.30, -73.50], showticklabels=False),
-                  yaxis=dict(range=[40.5, 40.95], showticklabels=False),
-                  images=[dict(
-                      source='data:image/png;base64,{}'.format(
-                          encoded_image.decode()),
-                      xref="x",
-                      yref="y",
-                      x=-74.30,
-                      y=40.95,
-                      sizex=0.8,
-                      sizey=0.45,
-                      sizing="stretch",
-                      layer="below")],
-                  hovermode='closest',
-                  showlegend=False,
-                  width=1156,
-                  height=851
-                  )
-
-    return {'data': location_trace(str(value)), 'layout': layout}
+warmer = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+if WARM_UP:
+    warmer.start()
 
 
 if __name__ == '__main__':
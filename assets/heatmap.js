@@ -0,0 +1,55 @@
+// Redraws the heatmap of app.py in the browser when the hour slider moves.
+// The whole cube (slot x lat x lon) is sent once as base64 encoded uint16
+// counts by the load_heatmap callback and decoded here only once.
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    heatmap: {
+        _packed: null,
+        _counts: null,
+
+        decode: function(packed) {
+            if (this._packed !== packed.data) {
+                var raw = atob(packed.data);
+                var bytes = new Uint8Array(raw.length);
+                for (var i = 0; i < raw.length; i++) {
+                    bytes[i] = raw.charCodeAt(i);
+                }
+                var view = new DataView(bytes.buffer);
+                var counts = new Float32Array(bytes.length / 2);
+                for (var j = 0; j < counts.length; j++) {
+                    counts[j] = view.getUint16(2 * j, true) * packed.step;
+                }
+                this._packed = packed.data;
+                this._counts = counts;
+            }
+            return this._counts;
+        },
+
+        frame: function(value, cube) {
+            if (!cube) {
+                return window.dash_clientside.no_update;
+            }
+            var ns = window.dash_clientside.heatmap;
+            var shape = cube.counts.shape;
+            var seconds = Math.round(value * 3600);
+            if (seconds % cube.slot !== 0 || seconds < 0 ||
+                    seconds / cube.slot >= shape[0]) {
+                return {data: [], layout: cube.layout};
+            }
+
+            var counts = ns.decode(cube.counts);
+            var offset = (seconds / cube.slot) * shape[1] * shape[2];
+            var z = [];
+            for (var row = 0; row < shape[1]; row++) {
+                var line = [];
+                for (var col = 0; col < shape[2]; col++) {
+                    var count = counts[offset + row * shape[2] + col];
+                    line.push(Math.round(count * 100) / 100);
+                }
+                z.push(line);
+            }
+            return {data: [Object.assign({}, cube.trace, {z: z})],
+                    layout: cube.layout};
+        }
+    }
+});
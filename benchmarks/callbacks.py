@@ -0,0 +1,181 @@
+"""Benchmark the callbacks of app.py on synthetic citywide data.
+
+Generates data.csv and live.csv of the requested size (see synthetic.py)
+into a working directory, loads app.py there and times every callback over
+a matrix of filter inputs. Results hold the best wall time and the peak
+traced memory of every case and are saved as JSON named after the current
+commit, so that runs of different commits can be compared:
+
+    python -m benchmarks.callbacks --rows 5000000 --days 28
+    python -m benchmarks.callbacks --compare benchmarks/results/1a2b3c4.json
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+
+import pandas as pd
+
+import aggregates
+from benchmarks import synthetic
+from benchmarks.timing import measure
+from boroughs import create_boroughs
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT, "benchmarks", "data")
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# filter inputs of the matrix, besides the date ranges which depend on the
+# generated data
+HOURS = [[0, 24], [7, 10], [17, 17]]
+TIME_DIVS = [15, 60]
+HOVERED = [None, "Brooklyn"]
+
+
+def commit():
+    """Short hash of the checked out commit, marked if there are changes"""
+    try:
+        rev = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                      cwd=ROOT).decode().strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=ROOT)
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return rev + "-dirty" if dirty else rev
+
+
+def dataset_dir(args):
+    """Working directory of a data set, generated unless it exists already"""
+    name = "r%i-d%i-rt%i-b%i-v%i-s%i" % (args.rows, args.days, args.routes,
+                                         args.boroughs, args.vehicles,
+                                         args.seed)
+    path = os.path.join(args.data, name)
+    if not os.path.exists(os.path.join(path, "data.csv")):
+        print("generating %s" % path)
+        synthetic.write_dataset(path, args.rows, args.days, args.routes,
+                                args.boroughs, args.vehicles, args.seed)
+    return path
+
+
+def date_ranges(historic):
+    """Whole history, its first week and a single day starting at noon"""
+    first, last = historic.first, historic.last
+    day = first.normalize() + pd.Timedelta(days=1)
+    week = min(first.normalize() + pd.Timedelta(days=7), last)
+    noon = day + pd.Timedelta(hours=12)
+    return [(str(first), str(last)), (str(first), str(week)),
+            (str(noon), str(day + pd.Timedelta(days=1)))]
+
+
+def cases(app, raw):
+    """Name, inputs, function, arguments and setup of every benchmark case"""
+    clear = app.figure_cache.clear
+    filters = list(itertools.product(HOURS, date_ranges(app.historic), TIME_DIVS))
+
+    yield "create_boroughs", {}, create_boroughs, (raw,), None
+    yield "location_data", {}, app.location_data.__wrapped__, (), None
+    yield "count_index", {}, app.count_index.__wrapped__, (), None
+    # built once, so the callbacks below are timed on a warm index
+    index = app.count_index()
+    boroughs = list(index.boroughs)
+
+    for hours, (start, end), time_div in filters:
+        inputs = {"hours": hours, "start_date": start, "end_date": end,
+                  "time_div": time_div}
+        args = (app.historic, hours, start, end, time_div)
+        yield "get_selected_data", inputs, app.get_selected_data, args, None
+        yield "get_vehicle_counts", inputs, app.get_vehicle_counts, args, None
+        yield ("query_counts", inputs, aggregates.query_counts,
+               (index, app.historic, boroughs, hours, start, end, time_div),
+               None)
+        yield ("violin_plot", inputs, app.violin_plot,
+               (None, hours, start, end, time_div, 1), clear)
+        for borough in HOVERED:
+            hover = {"points": [{"x": borough}]} if borough else None
+            yield ("daily_graph", dict(inputs, hover=borough),
+                   app.daily_graph,
+                   (None, hours, start, end, time_div, 1, hover), clear)
+
+
+def run(args):
+    """Time all cases on the data set of the arguments"""
+    path = dataset_dir(args)
+    # app.py loads its data from the working directory at import
+    os.chdir(path)
+    os.environ["LIVE_POLL_INTERVAL"] = "0"
+    os.environ["WARM_UP"] = "0"
+    sys.path.insert(0, ROOT)
+    import app
+
+    raw = pd.read_csv("data.csv", index_col=0)
+    results = []
+    for name, inputs, func, func_args, setup in cases(app, raw):
+        best, peak = measure(func, func_args, args.repeat, setup)
+        results.append({"callback": name, "inputs": inputs,
+                        "seconds": best, "peak_mb": peak / 1e6})
+        print("%-20s %9.1f ms %8.1f MB  %s" % (name, best * 1e3, peak / 1e6,
+                                              json.dumps(inputs)))
+
+    return {"commit": commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "dataset": {"rows": args.rows, "days": args.days,
+                        "routes": args.routes, "boroughs": args.boroughs,
+                        "vehicles": args.vehicles, "seed": args.seed},
+            "repeat": args.repeat,
+            "results": results}
+
+
+def case_key(result):
+    return result["callback"], json.dumps(result["inputs"], sort_keys=True)
+
+
+def compare(report, baseline):
+    """Print the change of every case against a saved baseline report"""
+    if report["dataset"] != baseline["dataset"]:
+        print("warning: data sets differ (%s vs %s)" % (report["dataset"],
+                                                        baseline["dataset"]))
+    before = {case_key(r): r for r in baseline["results"]}
+    print("\n%s vs %s" % (report["commit"], baseline["commit"]))
+    for result in report["results"]:
+        old = before.get(case_key(result))
+        if old is None:
+            continue
+        print("%-20s %6.2fx time %6.2fx memory  %s" % (
+            result["callback"], result["seconds"] / old["seconds"],
+            result["peak_mb"] / max(old["peak_mb"], 1e-6),
+            json.dumps(result["inputs"])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    synthetic.add_dataset_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data", default=DATA_DIR,
+                        help="directory holding the generated data sets")
+    parser.add_argument("--out", help="JSON file to save the results to, "
+                                      "by default named after the commit")
+    parser.add_argument("--compare", help="saved results to compare with")
+    args = parser.parse_args()
+    args.data = os.path.abspath(args.data)
+    out = os.path.abspath(args.out) if args.out else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+
+    report = run(args)
+
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out = os.path.join(RESULTS_DIR, "%s.json" % report["commit"])
+    with open(out, "w") as f:
+        json.dump(report, f, indent=1)
+    print("saved %s" % out)
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            compare(report, json.load(f))
@@ -0,0 +1,49 @@
+"""Compare the memory footprint of the historic data in both schemas.
+
+The original schema is data.csv as enriched by store.prepare_historic
+(object string ids, float64 coordinates, a datetime, an hour and six
+borough booleans). The compact schema is the one of the store (see
+store.compact_frame). Run from the repository root:
+
+    python -m benchmarks.memory [--csv data.csv]
+"""
+
+import argparse
+
+import store
+from benchmarks import synthetic
+
+
+def footprint(ddf):
+    """Bytes used by every column, including the strings of object ones"""
+    usage = ddf.memory_usage(index=False, deep=True)
+    return dict(zip(ddf.columns, usage.values))
+
+
+def report(wide, compact):
+    """Print bytes per row of every column in both schemas"""
+    rows = max(len(wide), 1)
+    for title, ddf in [("original", wide), ("compact", compact)]:
+        print("%s schema" % title)
+        for name, size in footprint(ddf).items():
+            print("  %-12s %-10s %7.2f bytes/row" % (name, ddf[name].dtype,
+                                                     size / rows))
+    before = sum(footprint(wide).values())
+    after = sum(footprint(compact).values())
+    print("\n%i rows: %.1f MB -> %.1f MB (%.1fx smaller)" % (
+        len(wide), before / 1e6, after / 1e6, before / max(after, 1)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--csv", help="historic data, synthetic if not given")
+    synthetic.add_dataset_arguments(parser)
+    args = parser.parse_args()
+
+    if args.csv:
+        wide = store.read_csv(args.csv)
+    else:
+        wide = store.prepare_historic(synthetic.historic_frame(
+            args.rows, args.days, args.routes, args.boroughs, args.vehicles,
+            seed=args.seed))
+    report(wide, store.compact_frame(wide))
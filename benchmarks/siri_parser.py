@@ -0,0 +1,46 @@
+"""Benchmark parsing a SIRI vehicle-monitoring response into live data.
+
+Compares flattening every VehicleActivity (the original path) with the
+parser that only keeps the columns of live.csv. Run from the repository
+root, optionally with a recorded response:
+
+    python -m benchmarks.siri_parser [--payload recorded.json]
+"""
+
+import argparse
+import json
+
+import live
+from benchmarks import synthetic
+from benchmarks.timing import measure
+
+
+def flatten_path(content):
+    """Original path: json, flatten every activity, select columns"""
+    return live.live_frame(live.flatten_vehicle_activity(json.loads(content)))
+
+
+def parse_path(content):
+    """Parser keeping only the needed fields"""
+    return live.prepare_live(live.parse_vehicle_activity(content))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--payload", help="recorded SIRI JSON response")
+    parser.add_argument("--vehicles", type=int, default=6000,
+                        help="vehicles in the synthetic citywide response")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.payload:
+        with open(args.payload, "rb") as f:
+            content = f.read()
+    else:
+        content = json.dumps(synthetic.siri_payload(args.vehicles)).encode()
+
+    rows = len(parse_path(content))
+    print("payload: %.1f MB, %i vehicles" % (len(content) / 1e6, rows))
+    for name, func in [("flatten", flatten_path), ("parse", parse_path)]:
+        best, peak = measure(func, (content,), args.repeat)
+        print("%-8s %8.1f ms %8.1f MB peak" % (name, best * 1e3, peak / 1e6))
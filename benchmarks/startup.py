@@ -0,0 +1,86 @@
+"""Benchmark the boot of a worker running app.py on synthetic data.
+
+Every run starts a fresh interpreter in the working directory of the data
+set (see callbacks.py), as a restarted dyno or recycled gunicorn worker
+does, and times its phases: importing app.py, serving the first layout and
+loading the historic data and aggregates in the background. With --build
+the store is removed before every run, so that it is built from data.csv
+again:
+
+    python -m benchmarks.startup --rows 5000000 --days 28 --repeat 5
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks import synthetic
+from benchmarks.callbacks import DATA_DIR, ROOT, dataset_dir
+
+
+# run in the child interpreter, printing the seconds since it started
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import app
+phases = {"import": time.perf_counter() - start,
+          "historic_ready": app.historic.ready}
+status = app.server.test_client().get("/_dash-layout").status_code
+phases["layout"] = time.perf_counter() - start
+phases["layout_status"] = status
+app.warmer.join()
+phases["warm"] = time.perf_counter() - start
+phases["matplotlib"] = "matplotlib" in sys.modules
+print(json.dumps(phases))
+"""
+
+PHASES = ["process", "import", "layout", "warm"]
+
+
+def boot(path, build=False):
+    """Phases of one boot of the app in a new process"""
+    if build:
+        shutil.rmtree(os.path.join(path, "data_store"), ignore_errors=True)
+    env = dict(os.environ, LIVE_POLL_INTERVAL="0",
+               PYTHONPATH=os.pathsep.join([ROOT, os.environ.get("PYTHONPATH",
+                                                                "")]))
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, "-c", CHILD], cwd=path,
+                                     env=env)
+    phases = json.loads(output.decode().strip().splitlines()[-1])
+    phases["process"] = time.perf_counter() - start
+    return phases
+
+
+def report(runs):
+    """Print the best and median seconds of every phase"""
+    for phase in PHASES:
+        seconds = [run[phase] for run in runs]
+        print("%-8s best %7.3f s  median %7.3f s" % (
+            phase, min(seconds), statistics.median(seconds)))
+    print("historic data ready at import in %i of %i runs, matplotlib "
+          "imported in %i, layout failed in %i" % (
+              sum(r["historic_ready"] for r in runs), len(runs),
+              sum(r["matplotlib"] for r in runs),
+              sum(r["layout_status"] != 200 for r in runs)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    synthetic.add_dataset_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--build", action="store_true",
+                        help="remove the store before every run")
+    parser.add_argument("--data", default=DATA_DIR,
+                        help="directory holding the generated data sets")
+    args = parser.parse_args()
+    args.data = os.path.abspath(args.data)
+
+    path = dataset_dir(args)
+    runs = [boot(path, args.build) for _ in range(args.repeat)]
+    report(runs)
@@ -0,0 +1,162 @@
+"""Synthetic data shaped like the feeds and files used by app.py.
+
+Running this module writes a citywide data.csv and live.csv of the given
+size into a directory:
+
+    python -m benchmarks.synthetic --rows 5000000 --days 28 --out citywide
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from boroughs import create_boroughs
+
+
+# route ids of every borough, as published by the MTA
+ROUTES = ["M1", "M2", "M4", "M15", "M15-SBS", "M101", "Bx1", "Bx12",
+          "Bx12-SBS", "BxM2", "Q32", "Q44-SBS", "QM2", "B44", "B63", "BM1",
+          "S40", "S79-SBS", "SIM1", "SIM4C", "X27"]
+
+
+def siri_payload(n_vehicles=6000, seed=0):
+    """SIRI vehicle-monitoring response with one VehicleActivity per vehicle,
+    carrying the nested journey, call and distance details of the real feed"""
+    rng = np.random.RandomState(seed)
+    routes = rng.choice(ROUTES, n_vehicles)
+    lats = rng.uniform(40.5, 40.95, n_vehicles)
+    lons = rng.uniform(-74.3, -73.5, n_vehicles)
+    seconds = rng.randint(0, 180, n_vehicles)
+
+    activity = []
+    for it in range(n_vehicles):
+        route = str(routes[it])
+        recorded = "2018-12-08T14:%02i:%02i.000-05:00" % (
+            30 + seconds[it] // 60, seconds[it] % 60)
+        call = {"Extensions": {"Distances": {
+                    "PresentableDistance": "approaching",
+                    "DistanceFromCall": 120.5, "StopsFromCall": 0,
+                    "CallDistanceAlongRoute": 3251.88}},
+                "StopPointRef": "MTA_%i" % (400000 + it),
+                "VisitNumber": 1, "StopPointName": "BROADWAY/W 72 ST"}
+        journey = {"LineRef": "MTA NYCT_" + route,
+                   "DirectionRef": str(it % 2),
+                   "FramedVehicleJourneyRef": {
+                       "DataFrameRef": "2018-12-08",
+                       "DatedVehicleJourneyRef": "MTA NYCT_%s_%i" % (route,
+                                                                     it)},
+                   "JourneyPatternRef": "MTA_%s0093" % route,
+                   "PublishedLineName": route,
+                   "OperatorRef": "MTA NYCT",
+                   "OriginRef": "MTA_%i" % (300000 + it),
+                   "DestinationName": "SELECT BUS SOUTH FERRY",
+                   "SituationRef": [],
+                   "Monitored": True,
+                   "VehicleLocation": {"Longitude": lons[it],
+                                       "Latitude": lats[it]},
+                   "Bearing": 243.7,
+                   "ProgressRate": "normalProgress",
+                   "BlockRef": "MTA NYCT_MQ_A2-Weekday_%i" % it,
+                   "VehicleRef": "MTA NYCT_%i" % (3000 + it),
+                   "MonitoredCall": call,
+                   "OnwardCalls": {"OnwardCall": [call]}}
+        activity.append({"MonitoredVehicleJourney": journey,
+                         "RecordedAtTime": recorded})
+
+    delivery = {"VehicleActivity": activity,
+                "ResponseTimestamp": "2018-12-08T14:33:00.000-05:00",
+                "ValidUntil": "2018-12-08T14:34:00.000-05:00"}
+    return {"Siri": {"ServiceDelivery": {
+        "ResponseTimestamp": "2018-12-08T14:33:00.000-05:00",
+        "VehicleMonitoringDelivery": [delivery],
+        "SituationExchangeDelivery": []}}}
+
+
+# route id prefixes of the boroughs, in the order they are added when
+# generating fewer boroughs (the shipped history is Manhattan only)
+BOROUGH_PREFIXES = ["M", "Bx", "B", "Q", "S", "SIM"]
+# bounding box of the pings, the extent of the heatmap
+LATS = (40.5, 40.95)
+LONS = (-74.3, -73.5)
+
+
+def route_ids(n_routes, n_boroughs=6):
+    """Route ids spread evenly over the first n_boroughs boroughs"""
+    prefixes = BOROUGH_PREFIXES[:n_boroughs]
+    return ["%s%i" % (prefixes[it % len(prefixes)], it // len(prefixes) + 1)
+            for it in range(n_routes)]
+
+
+def pings(start, seconds, vehicles, n_vehicles, n_routes, n_boroughs, rng):
+    """Pings of vehicles that each stay on one route, at seconds after start"""
+    rows = len(seconds)
+    routes = np.array(route_ids(n_routes, n_boroughs))
+    vehicle_routes = rng.randint(0, n_routes, n_vehicles)
+    ids = np.array(["MTA NYCT_%i" % (3000 + it) for it in range(n_vehicles)])
+    order = np.argsort(seconds, kind="mergesort")
+    return pd.DataFrame({
+        "timestamp": pd.Timestamp(start) + pd.to_timedelta(seconds[order],
+                                                            unit="s"),
+        "vehicle_id": ids[vehicles[order]],
+        "route_id": routes[vehicle_routes[vehicles[order]]],
+        "latitude": rng.uniform(LATS[0], LATS[1], rows),
+        "longitude": rng.uniform(LONS[0], LONS[1], rows)})
+
+
+def historic_frame(rows=1000000, days=28, n_routes=300, n_boroughs=6,
+                   n_vehicles=6000, start="2015-09-01", seed=0):
+    """Raw historic pings shaped like data.csv"""
+    rng = np.random.RandomState(seed)
+    seconds = rng.randint(0, days * 86400, rows)
+    vehicles = rng.randint(0, n_vehicles, rows)
+    return pings(start, seconds, vehicles, n_vehicles, n_routes, n_boroughs,
+                 rng)
+
+
+def live_frame(n_vehicles=6000, n_routes=300, n_boroughs=6,
+               start="2018-12-08 14:30:00", seed=1):
+    """One SIRI snapshot of every vehicle shaped like live.csv"""
+    rng = np.random.RandomState(seed)
+    seconds = rng.randint(0, 180, n_vehicles)
+    ddf = pings(start, seconds, np.arange(n_vehicles), n_vehicles, n_routes,
+                n_boroughs, rng)
+    return create_boroughs(ddf)
+
+
+def write_dataset(out_dir, rows=1000000, days=28, n_routes=300, n_boroughs=6,
+                  n_vehicles=6000, seed=0):
+    """Write data.csv and live.csv into out_dir"""
+    os.makedirs(out_dir, exist_ok=True)
+    historic_frame(rows, days, n_routes, n_boroughs, n_vehicles,
+                   seed=seed).to_csv(os.path.join(out_dir, "data.csv"),
+                                     date_format="%Y-%m-%d %H:%M:%S")
+    live_ddf = live_frame(n_vehicles, n_routes, n_boroughs, seed=seed + 1)
+    live_ddf.drop(columns="borough").to_csv(
+        os.path.join(out_dir, "live.csv"),
+        date_format="%Y-%m-%d %H:%M:%S.000")
+
+
+def add_dataset_arguments(parser):
+    """Size options of the synthetic data set"""
+    parser.add_argument("--rows", type=int, default=1000000,
+                        help="historic pings")
+    parser.add_argument("--days", type=int, default=28,
+                        help="days of historic data")
+    parser.add_argument("--routes", type=int, default=300)
+    parser.add_argument("--boroughs", type=int, default=6,
+                        choices=range(1, len(BOROUGH_PREFIXES) + 1))
+    parser.add_argument("--vehicles", type=int, default=6000)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_dataset_arguments(parser)
+    parser.add_argument("--out", default=".",
+                        help="directory to write data.csv and live.csv to")
+    args = parser.parse_args()
+
+    write_dataset(args.out, args.rows, args.days, args.routes, args.boroughs,
+                  args.vehicles, args.seed)
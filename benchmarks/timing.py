@@ -0,0 +1,24 @@
+"""Timing and memory measurements shared by the benchmarks"""
+
+import time
+import tracemalloc
+
+
+def measure(func, args, repeat, setup=None):
+    """Best wall time over repeats and peak traced memory of one call.
+    setup() is called before every call, e.g. to drop caches"""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
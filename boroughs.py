@@ -0,0 +1,79 @@
+"""Translating bus route ids to the boroughs they run in"""
+
+import functools
+import re
+
+import numpy as np
+import pandas as pd
+
+
+# dictionaries translating bus route_id acronyms to boroughs
+dic_borough = {"M": "Manhattan", "Bx": "Bronx", "B": "Brooklyn", "Q": "Queens",
+               "S": "Staten Island", "SIM": "Express to Manhattan"}
+inv_dic_borough = {v: k for k, v in dic_borough.items()}
+
+# patterns a route_id is searched for to tell if it runs in a borough, in
+# the order of the boolean columns added by create_boroughs
+borough_patterns = [("M", re.compile('M')),
+                    ("S", re.compile(r'^S\d+')),
+                    ("Bx", re.compile('Bx')),
+                    ("Q", re.compile('Q')),
+                    ("B", re.compile(r"^B([A-Z]|\d)")),
+                    ("SIM", re.compile(r"^SIM"))]
+# bit of each borough in the packed "borough" column
+borough_bits = {col: 1 << it for it, (col, _) in enumerate(borough_patterns)}
+
+
+@functools.lru_cache(maxsize=None)
+def route_bits(route_id):
+    """Packed borough bits of a single route id"""
+    bits = 0
+    for col, pattern in borough_patterns:
+        if pattern.search(route_id):
+            bits |= borough_bits[col]
+    return bits
+
+
+def classify_routes(route_ids):
+    """Packed borough bits for a series of route ids. Every distinct id is
+    only classified once and missing ids are in no borough"""
+    if isinstance(route_ids.dtype, pd.CategoricalDtype):
+        codes = route_ids.cat.codes.values
+        uniques = route_ids.cat.categories
+    else:
+        codes, uniques = pd.factorize(route_ids)
+    # code -1 (missing id) picks the trailing 0
+    unique_bits = np.array([route_bits(str(r)) for r in uniques] + [0],
+                           dtype=np.uint8)
+    return unique_bits[codes]
+
+
+def create_boroughs(ddf):
+    """Add boolean columns for whether a route is in a specific borough,
+    and all of them packed into the bits of a "borough" column"""
+    new = ddf.copy()
+    bits = classify_routes(new.route_id)
+    for col, _ in borough_patterns:
+        new[col] = (bits & borough_bits[col]) > 0
+    new["borough"] = bits
+    return new
+
+
+def borough_codes(ddf):
+    """Packed borough bits of every row, also for frames that only have the
+    boolean columns (e.g. live data saved before the packed column)"""
+    if "borough" in ddf:
+        return ddf["borough"].values.astype(np.uint8)
+    bits = np.zeros(len(ddf), dtype=np.uint8)
+    for col, _ in borough_patterns:
+        bits |= np.where(ddf[col].values.astype(bool), borough_bits[col], 0
+                         ).astype(np.uint8)
+    return bits
+
+
+def borough_members(bits, keys):
+    """Boolean matrix of which rows are in each borough key ("All" holds
+    every row) for packed borough bits"""
+    return np.column_stack([np.ones(len(bits), dtype=bool) if key == "All"
+                            else (bits & borough_bits[key]) > 0
+                            for key in keys])
@@ -0,0 +1,112 @@
+"""Memoizing figures and aggregates of the callbacks in app.py"""
+
+import collections
+import functools
+import json
+import threading
+
+import metrics
+
+
+def memoize_once(func):
+    """Decorate a function to be computed once per arguments, however many
+    threads ask for it at the same time: the first computes it while the
+    others wait for its result. Failed computations are not remembered"""
+    results = {}
+    locks = collections.defaultdict(threading.Lock)
+    guard = threading.Lock()
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        if args in results:
+            return results[args]
+        with guard:
+            lock = locks[args]
+        with lock:
+            if args not in results:
+                results[args] = func(*args)
+            return results[args]
+
+    return wrapper
+
+
+class FigureCache(object):
+    """Bounded LRU cache of figures shared by several callbacks.
+
+    Figures are keyed on the name of the function computing them and its
+    arguments. The whole cache is dropped whenever version() changes, e.g.
+    when the live data has been refreshed."""
+
+    def __init__(self, maxsize=128, version=None):
+        self.maxsize = maxsize
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._figures = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def memoize(self, func):
+        """Decorate a function whose figure only depends on its arguments
+        and the version"""
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            key = (func.__name__, json.dumps(args, sort_keys=True, default=str))
+            found, figure, version = self._lookup(key)
+            metrics.note("cache_hit", found)
+            if not found:
+                figure = func(*args)
+                self.put(key, figure, version)
+            return figure
+
+        return wrapper
+
+    def get(self, key):
+        """Return the cached figure or None, counting hits and misses"""
+        return self._lookup(key)[1]
+
+    def put(self, key, figure, version=None):
+        """Store a figure, evicting the least recently used beyond maxsize.
+        If given, the figure is only stored while the version it was
+        computed for is still current"""
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            self._figures[key] = figure
+            self._figures.move_to_end(key)
+            while len(self._figures) > self.maxsize:
+                self._figures.popitem(last=False)
+
+    def clear(self):
+        """Drop all cached figures"""
+        with self._lock:
+            self._figures.clear()
+
+    def stats(self):
+        """Hit and miss counters and current size"""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._figures), "maxsize": self.maxsize,
+                    "version": self._version}
+
+    def _lookup(self, key):
+        """Whether the key is cached, its figure and the current version"""
+        with self._lock:
+            self._check_version()
+            if key in self._figures:
+                self._figures.move_to_end(key)
+                self.hits += 1
+                return True, self._figures[key], self._version
+            self.misses += 1
+            return False, None, self._version
+
+    def _check_version(self):
+        """Drop all figures if the version has moved on since they were
+        computed"""
+        if self.version is None:
+            return
+        version = self.version()
+        if version != self._version:
+            self._figures.clear()
+            self._version = version
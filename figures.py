@@ -0,0 +1,113 @@
+"""Keeping the figures sent to the browser small and their colorscales
+prebuilt.
+
+Running this module converts the matplotlib colormaps of the figures into
+colorscales.json, so that the app does not import matplotlib:
+
+    python figures.py
+"""
+
+import argparse
+import base64
+import functools
+import json
+import os
+
+import numpy as np
+
+
+# whether figures are rounded and decimated before being sent, set
+# COMPACT_FIGURES=0 to send the full precision data
+COMPACT = os.environ.get("COMPACT_FIGURES", "1") != "0"
+# most points sent for a single series and decimals kept of plotted values
+POINT_BUDGET = int(os.environ.get("FIGURE_POINT_BUDGET", 500))
+DECIMALS = 2
+
+# plotly colorscales converted from matplotlib colormaps
+COLORSCALES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "colorscales.json")
+COLORMAPS = ["viridis"]
+COLORSCALE_ENTRIES = 255
+
+
+def compact(values, decimals=DECIMALS):
+    """Round plotted values, which shortens their JSON representation"""
+    if not COMPACT:
+        return values
+    return np.round(np.asarray(values, dtype=float), decimals)
+
+
+def decimate(x, y, budget=POINT_BUDGET):
+    """Keep at most budget points of a series, keeping the minimum and
+    maximum of every stretch of points so that peaks stay visible"""
+    x, y = np.asarray(x), np.asarray(y)
+    if not COMPACT or len(y) <= budget:
+        return x, y
+
+    n_bins = max(budget // 2, 1)
+    edges = np.linspace(0, len(y), n_bins + 1).astype(int)
+    keep = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        if stop > start:
+            stretch = y[start:stop]
+            keep.extend({start + np.argmin(stretch),
+                         start + np.argmax(stretch)})
+    keep = np.sort(keep)
+    return x[keep], y[keep]
+
+
+def pack_uint16(values):
+    """Quantize non-negative values to little-endian uint16 and encode them
+    as base64, about 2.7 characters per value in JSON. The browser decodes
+    them into a typed array and multiplies by the returned step"""
+    values = np.asarray(values, dtype=float)
+    top = values.max() if values.size else 0.
+    step = top / 65535. if top > 0 else 1.
+    packed = np.round(values / step).astype("<u2")
+    return {"data": base64.b64encode(packed.tobytes()).decode("ascii"),
+            "step": step, "shape": list(values.shape)}
+
+
+def matplotlib_to_plotly(cmap, pl_entries):
+    """Convert matplotlib colormap to plotly version"""
+    h = 1.0 / (pl_entries - 1)
+    pl_colorscale = []
+
+    for k in range(pl_entries):
+        C = [int(c) for c in np.uint8(np.array(cmap(k * h)[:3]) * 255)]
+        pl_colorscale.append([k * h, 'rgb' + str((C[0], C[1], C[2]))])
+
+    return pl_colorscale
+
+
+def convert_colormap(name, entries=COLORSCALE_ENTRIES):
+    """Colorscale of a matplotlib colormap, importing matplotlib"""
+    from matplotlib import cm
+    return matplotlib_to_plotly(cm.get_cmap(name), entries)
+
+
+@functools.lru_cache(maxsize=None)
+def colorscale(name, path=COLORSCALES_PATH):
+    """Prebuilt colorscale of a matplotlib colormap, converted on the fly if
+    missing from the prebuilt ones. The returned list is shared"""
+    try:
+        with open(path) as f:
+            return json.load(f)[name]
+    except (OSError, ValueError, KeyError):
+        return convert_colormap(name)
+
+
+def build_colorscales(path=COLORSCALES_PATH, names=COLORMAPS):
+    """Write the colorscales of all colormaps used by the figures"""
+    with open(path, "w") as f:
+        json.dump({name: convert_colormap(name) for name in names}, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Prebuild the colorscales of the figures")
+    parser.add_argument("--out", default=COLORSCALES_PATH,
+                        help="JSON file to write the colorscales to")
+    args = parser.parse_args()
+
+    build_colorscales(args.out)
@@ -0,0 +1,77 @@
+"""Fixed spatial grid of NYC the heatmaps are binned on.
+
+The grid covers the bounds of the map image of the heatmap in app.py, so
+historic and live pings fall into the same cells whatever their extent.
+Coordinates are converted to integer units of 1e-5 degrees (about a meter)
+once, after which the cell of a ping is found by integer arithmetic only.
+"""
+
+import collections
+import functools
+
+import numpy as np
+
+
+# bounds of assets/openstreetmap_nyc.png in degrees
+WEST, EAST = -74.30, -73.50
+SOUTH, NORTH = 40.5, 40.95
+# integer units per degree
+SCALE = 10 ** 5
+
+# number of latitude and longitude bins of every selectable resolution,
+# which have to divide the bounds in whole units
+RESOLUTIONS = collections.OrderedDict([("coarse", (15, 10)),
+                                       ("medium", (30, 40)),
+                                       ("fine", (60, 80))])
+DEFAULT_RESOLUTION = "coarse"
+
+Grid = collections.namedtuple(
+    "Grid", ["resolution", "n_lats", "n_lons", "lat_edges", "lon_edges",
+             "lat_mids", "lon_mids"])
+
+
+def units(degrees):
+    """Integer units of the grid of coordinates in degrees"""
+    return np.rint(np.asarray(degrees, dtype=np.float64) * SCALE).astype(
+        np.int64)
+
+
+@functools.lru_cache(maxsize=None)
+def get_grid(resolution=DEFAULT_RESOLUTION):
+    """Edges and midpoints of the cells of a resolution"""
+    n_lats, n_lons = RESOLUTIONS[resolution]
+    lat_edges = np.linspace(SOUTH, NORTH, n_lats + 1)
+    lon_edges = np.linspace(WEST, EAST, n_lons + 1)
+    return Grid(resolution, n_lats, n_lons, lat_edges, lon_edges,
+                (lat_edges[1:] + lat_edges[:-1]) / 2,
+                (lon_edges[1:] + lon_edges[:-1]) / 2)
+
+
+def axis_bins(values, low, high, n_bins):
+    """Bin of every coordinate along one axis, -1 outside the bounds or
+    missing"""
+    values = np.asarray(values, dtype=np.float64)
+    bins = np.full(values.shape, -1, dtype=np.int64)
+    finite = np.isfinite(values)
+    offsets = units(values[finite]) - units(low)
+    span = int(units(high) - units(low))
+    inside = (offsets >= 0) & (offsets < span)
+    found = np.full(offsets.shape, -1, dtype=np.int64)
+    found[inside] = offsets[inside] * n_bins // span
+    bins[finite] = found
+    return bins
+
+
+def cells(latitudes, longitudes, resolution=DEFAULT_RESOLUTION):
+    """Cell of every ping, numbered row-major from the south-west corner,
+    -1 outside the grid"""
+    grid = get_grid(resolution)
+    lat_bins = axis_bins(latitudes, SOUTH, NORTH, grid.n_lats)
+    lon_bins = axis_bins(longitudes, WEST, EAST, grid.n_lons)
+    return np.where((lat_bins >= 0) & (lon_bins >= 0),
+                    lat_bins * grid.n_lons + lon_bins, -1)
+
+
+def n_cells(resolution=DEFAULT_RESOLUTION):
+    n_lats, n_lons = RESOLUTIONS[resolution]
+    return n_lats * n_lons
@@ -0,0 +1,492 @@
+"""Polling the live data from the MTA Bus Time API and keeping the latest
+snapshot in memory"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import requests
+
+from aggregates import BASE_SLOT, SECONDS_PER_DAY, epoch_seconds
+from boroughs import borough_codes, borough_members, create_boroughs, \
+    dic_borough
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+LIVE_PATH = "live.csv"
+HISTORY_PATH = "live_history.npz"
+
+# SIRI vehicle-monitoring feed of the MTA Bus Time API
+SIRI_URL = os.environ.get(
+    "SIRI_URL", "http://bustime.mta.info/api/siri/vehicle-monitoring.json")
+SIRI_PARAMS = {"key": os.environ.get("SIRI_KEY",
+                                     "19faff8a-c061-4c7e-8dc4-63685ab24123"),
+               "MaximumStopVisits": 2}
+# seconds between polls of the feed, 0 disables the background poller
+POLL_INTERVAL = float(os.environ.get("LIVE_POLL_INTERVAL", 60))
+
+# columns kept from the flattened feed and their names in live.csv
+LIVE_COLUMNS = {'RecordedAtTime': "timestamp",
+                'MonitoredVehicleJourney_VehicleRef': "vehicle_id",
+                "MonitoredVehicleJourney_PublishedLineName": "route_id",
+                'MonitoredVehicleJourney_VehicleLocation_Latitude': "latitude",
+                'MonitoredVehicleJourney_VehicleLocation_Longitude': "longitude"}
+# keys on the path from the root of a SIRI response to those columns
+_SIRI_KEYS = {"Siri", "ServiceDelivery", "VehicleMonitoringDelivery",
+              "VehicleActivity", "RecordedAtTime", "MonitoredVehicleJourney",
+              "VehicleRef", "PublishedLineName", "VehicleLocation",
+              "Latitude", "Longitude"}
+
+logger = logging.getLogger(__name__)
+
+
+def flatten_vehicle_activity(resp):
+    """Flatten every VehicleActivity of a SIRI response into a dataframe"""
+
+    def _flatten_dict(root_key, nested_dict, flattened_dict):
+        """Flatten json file from MTA Bus Time API"""
+        for key, value in nested_dict.items():
+            next_key = root_key + "_" + key if root_key != "" else key
+            if isinstance(value, dict):
+                _flatten_dict(next_key, value, flattened_dict)
+            else:
+                flattened_dict[next_key] = value
+        return flattened_dict
+
+    info = resp['Siri']['ServiceDelivery'][
+        'VehicleMonitoringDelivery'][0]['VehicleActivity']
+    return pd.DataFrame([_flatten_dict('', i, {}) for i in info])
+
+
+def parse_vehicle_activity(content):
+    """Parse a SIRI response (str or bytes) straight into the columns of
+    live.csv, without flattening every VehicleActivity.
+
+    The decoder hands every JSON object to a hook as soon as it is
+    complete. The hook drops everything but the fields in LIVE_COLUMNS, so
+    the large nested parts of each activity are freed right away and each
+    activity ends up as a tuple. Other objects keep their known keys, so a
+    delivery without VehicleActivity (e.g. an ErrorCondition reply) raises
+    KeyError as when flattening."""
+
+    def _hook(pairs):
+        keep = {k: v for k, v in pairs if k in _SIRI_KEYS}
+        if "MonitoredVehicleJourney" in keep and "RecordedAtTime" in keep:
+            journey = keep["MonitoredVehicleJourney"] or {}
+            location = journey.get("VehicleLocation") or {}
+            return (keep["RecordedAtTime"], journey.get("VehicleRef"),
+                    journey.get("PublishedLineName"),
+                    location.get("Latitude"), location.get("Longitude"))
+        return keep
+
+    resp = json.loads(content, object_pairs_hook=_hook)
+    info = resp['Siri']['ServiceDelivery'][
+        'VehicleMonitoringDelivery'][0]['VehicleActivity']
+
+    columns = list(zip(*info)) if info else [()] * len(LIVE_COLUMNS)
+    timestamp, vehicle_id, route_id, latitude, longitude = columns
+    return pd.DataFrame({"timestamp": np.array(timestamp, dtype=object),
+                         "vehicle_id": np.array(vehicle_id, dtype=object),
+                         "route_id": np.array(route_id, dtype=object),
+                         "latitude": np.array(latitude, dtype=float),
+                         "longitude": np.array(longitude, dtype=float)})
+
+
+def live_frame(current):
+    """Select and rename the columns of the flattened feed used in live.csv"""
+    sel_curr = current[list(LIVE_COLUMNS)]
+    sel_curr = sel_curr.rename(index=str, columns=LIVE_COLUMNS)
+    return prepare_live(sel_curr)
+
+
+def prepare_live(sel_curr):
+    """Convert timestamps and add boroughs to the selected live columns"""
+    # put into timestamp into EST
+    sel_curr["timestamp"] = pd.to_datetime(sel_curr["timestamp"]) - \
+        pd.Timedelta(hours=4)
+    # get boolean columns for boroughs
+    return create_boroughs(sel_curr)
+
+
+class LiveSnapshot(object):
+    """Latest live data, parsed once per refresh and shared by callbacks.
+
+    The snapshot on disk is replaced atomically, so other workers never
+    read a partially written file. Each worker only parses it again when
+    the file on disk has changed, which also bumps the version number."""
+
+    def __init__(self, path=LIVE_PATH, history=None):
+        self.path = path
+        self.history = history
+        self.version = 0
+        self._stamp = None
+        self._frame = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Reload the snapshot if it changed on disk. Returns the version"""
+        stamp = self._disk_stamp()
+        with self._lock:
+            if stamp != self._stamp:
+                self._load(stamp)
+            return self.version
+
+    def frame(self):
+        """Latest live data"""
+        self.refresh()
+        return self._frame
+
+    def publish(self, ddf):
+        """Atomically replace the snapshot on disk and in memory"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(suffix=".csv", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                ddf.to_csv(f)
+            # mkstemp only lets the owner read the file
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._load(self._disk_stamp())
+        if self.history is not None:
+            self.history.save()
+        return self.version
+
+    def _load(self, stamp):
+        """Parse the snapshot on disk, as it was when stamped"""
+        if stamp is None:
+            self._frame = None
+        else:
+            self._frame = pd.read_csv(self.path, index_col=0,
+                                      parse_dates=True)
+            if self.history is not None:
+                self.history.append(self._frame)
+        self._stamp = stamp
+        self.version += 1
+
+    def _disk_stamp(self):
+        """Identify the file on disk, which is new after every publish"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class LiveHistory(object):
+    """Rolling history of the live pings of every snapshot.
+
+    Pings are kept in a fixed size ring buffer (seconds since the epoch,
+    vehicle code and packed borough bits). Alongside, the unique
+    (vehicle, borough) pairs of every 15 minute bucket are updated as
+    snapshots are appended, so counts per time bucket never rescan the
+    pings. Buckets older than the retention are dropped, which bounds
+    memory by the retention rather than the uptime. The counts only come
+    from the buckets, which are saved with the pings, so that a busy feed
+    overflowing the ring does not shorten the history of a restarted
+    worker."""
+
+    keys = ["All"] + list(dic_borough)
+
+    def __init__(self, path=HISTORY_PATH, retention=SECONDS_PER_DAY,
+                 capacity=500000):
+        self.path = path
+        self.retention = retention
+        self.capacity = capacity
+        self._seconds = np.zeros(capacity, dtype=np.int64)
+        self._vehicles = np.zeros(capacity, dtype=np.int32)
+        self._bits = np.zeros(capacity, dtype=np.uint8)
+        self._next = 0
+        self._size = 0
+        # codes of vehicle ids and the latest ping seen of each vehicle
+        self._vehicle_codes = {}
+        self._last_seen = np.zeros(0, dtype=np.int64)
+        # unique vehicle * 8 + borough key per 15 minute bucket
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return self._size
+
+    def append(self, ddf):
+        """Add the pings of a snapshot not seen before"""
+        if ddf is None or ddf.empty:
+            return
+        timestamps = pd.to_datetime(ddf.timestamp)
+        if timestamps.dt.tz is not None:
+            timestamps = timestamps.dt.tz_localize(None)
+        with self._lock:
+            vehicles = self._encode(ddf.vehicle_id.values)
+            self._append(epoch_seconds(timestamps), vehicles,
+                         borough_codes(ddf))
+
+    def counts(self, time_div, key="All"):
+        """Unique vehicles of a borough key per time bucket of time_div
+        minutes. Returns bucket starts in seconds since the epoch and
+        counts"""
+        it = self.keys.index(key)
+        per_div = time_div * 60 // BASE_SLOT
+        merged = {}
+        with self._lock:
+            for bucket, pairs in self._buckets.items():
+                pairs = pairs[pairs % 8 == it]
+                merged.setdefault(bucket // per_div, []).append(pairs)
+
+        starts = np.array(sorted(merged), dtype=np.int64)
+        counts = np.array([np.unique(np.concatenate(merged[b])).size
+                           for b in starts], dtype=np.int64)
+        return starts * time_div * 60, counts
+
+    def span(self):
+        """Seconds of live data the counts cover, at most the retention"""
+        with self._lock:
+            if not self._buckets:
+                return 0
+            return min((max(self._buckets) - min(self._buckets) + 1) *
+                       BASE_SLOT, self.retention)
+
+    def save(self):
+        """Write the buckets and the pings within the retention next to the
+        snapshot"""
+        if self.path is None:
+            return
+        with self._lock:
+            order = (np.arange(self._size) + self._next - self._size) % \
+                self.capacity
+            vehicle_ids = np.array(sorted(self._vehicle_codes,
+                                          key=self._vehicle_codes.get),
+                                   dtype=object)
+            recent = self._seconds[order] >= \
+                self._last_seen.max(initial=0) - self.retention
+            seconds = self._seconds[order][recent]
+            vehicles = self._vehicles[order][recent]
+            bits = self._bits[order][recent]
+            last_seen = self._last_seen.copy()
+            bucket_ids = np.array(sorted(self._buckets), dtype=np.int64)
+            pairs = [self._buckets[b] for b in bucket_ids]
+        bucket_sizes = np.array([p.size for p in pairs], dtype=np.int64)
+        pairs = np.concatenate(pairs + [np.zeros(0, dtype=np.int64)])
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(suffix=".npz", dir=directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, seconds=seconds, vehicles=vehicles, bits=bits,
+                         vehicle_ids=vehicle_ids.astype(str),
+                         last_seen=last_seen, bucket_ids=bucket_ids,
+                         bucket_sizes=bucket_sizes, pairs=pairs)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def load(self):
+        """Replace the history by the one saved on disk"""
+        with np.load(self.path) as saved:
+            saved = {k: saved[k] for k in saved.files}
+        seconds, vehicles, bits = (saved["seconds"], saved["vehicles"],
+                                   saved["bits"])
+        vehicle_ids = saved["vehicle_ids"]
+        with self._lock:
+            self._next = self._size = 0
+            self._buckets = {}
+            self._vehicle_codes = {v: it for it, v in enumerate(vehicle_ids)}
+            if "pairs" not in saved:
+                # saved without its buckets, which are rebuilt from the pings
+                self._last_seen = np.full(len(vehicle_ids),
+                                          np.iinfo(np.int64).min)
+                self._append(seconds, vehicles, bits)
+                return
+            self._last_seen = saved["last_seen"]
+            self._store(seconds, vehicles, bits)
+            ends = np.cumsum(saved["bucket_sizes"])[:-1]
+            self._buckets = dict(zip(saved["bucket_ids"].tolist(),
+                                     np.split(saved["pairs"], ends)))
+            self._expire()
+
+    def _encode(self, vehicle_ids):
+        """Integer codes of vehicle ids, adding codes for new ids"""
+        uniques, inverse = np.unique(vehicle_ids.astype(str),
+                                     return_inverse=True)
+        codes = np.array([self._vehicle_codes.setdefault(v,
+                                                         len(self._vehicle_codes))
+                          for v in uniques], dtype=np.int32)
+        if len(self._vehicle_codes) > len(self._last_seen):
+            grown = np.full(len(self._vehicle_codes), np.iinfo(np.int64).min)
+            grown[:len(self._last_seen)] = self._last_seen
+            self._last_seen = grown
+        return codes[inverse]
+
+    def _append(self, seconds, vehicles, bits):
+        # skip pings that are not newer than the last one of their vehicle,
+        # e.g. the same snapshot loaded twice
+        new = seconds > self._last_seen[vehicles]
+        seconds, vehicles, bits = seconds[new], vehicles[new], bits[new]
+        if not seconds.size:
+            return
+        np.maximum.at(self._last_seen, vehicles, seconds)
+        self._store(seconds, vehicles, bits)
+
+        # merge the new (vehicle, borough) pairs into their buckets
+        row_it, key_it = np.nonzero(borough_members(bits, self.keys))
+        buckets = seconds[row_it] // BASE_SLOT
+        pairs = vehicles[row_it].astype(np.int64) * 8 + key_it
+        for bucket in np.unique(buckets):
+            new_pairs = pairs[buckets == bucket]
+            if bucket in self._buckets:
+                new_pairs = np.concatenate([self._buckets[bucket], new_pairs])
+            self._buckets[bucket] = np.unique(new_pairs)
+        self._expire()
+
+    def _store(self, seconds, vehicles, bits):
+        """Write pings to the ring buffer, which only keeps the latest
+        beyond its capacity"""
+        if not seconds.size:
+            return
+        keep = slice(-self.capacity, None)
+        slots = (self._next + np.arange(seconds[keep].size)) % self.capacity
+        self._seconds[slots] = seconds[keep]
+        self._vehicles[slots] = vehicles[keep]
+        self._bits[slots] = bits[keep]
+        self._next = (slots[-1] + 1) % self.capacity
+        self._size = min(self._size + seconds[keep].size, self.capacity)
+
+    def _expire(self):
+        """Drop the buckets older than the retention"""
+        if not self._last_seen.size:
+            return
+        oldest = (self._last_seen.max() - self.retention) // BASE_SLOT
+        for bucket in [b for b in self._buckets if b < oldest]:
+            del self._buckets[bucket]
+
+
+class SiriPoller(object):
+    """Fetch the SIRI feed in a background thread and publish every response
+    to a LiveSnapshot.
+
+    Requests share one pooled session and time out. Failed polls are
+    retried with exponential backoff. With several workers, only the one
+    holding the lock file polls, while the others pick the published
+    snapshot up from disk."""
+
+    def __init__(self, snapshot, url=SIRI_URL, params=None,
+                 interval=POLL_INTERVAL, timeout=(5, 30), max_backoff=600,
+                 session=None):
+        self.snapshot = snapshot
+        self.url = url
+        self.params = SIRI_PARAMS if params is None else params
+        self.interval = interval
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.last_success = None
+
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=2)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock_file = None
+
+    @property
+    def running(self):
+        """Whether the background thread is polling"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def fetch(self):
+        """Request the latest live feed and convert it for live.csv"""
+        resp = self.session.get(self.url, params=self.params,
+                                timeout=self.timeout)
+        resp.raise_for_status()
+        return prepare_live(parse_vehicle_activity(resp.content))
+
+    def poll_once(self):
+        """Fetch and publish one snapshot. Returns the snapshot version"""
+        version = self.snapshot.publish(self.fetch())
+        self.failures = 0
+        self.last_success = time.time()
+        return version
+
+    def start(self):
+        """Start polling in a daemon thread"""
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="siri-poller",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop polling and wait for the thread to finish"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._release_lock()
+
+    def next_wait(self):
+        """Seconds until the next poll, backing off after failures"""
+        if self.failures == 0:
+            return self.interval
+        return min(self.interval * 2 ** self.failures, self.max_backoff)
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                if self._acquire_lock():
+                    try:
+                        self.poll_once()
+                    except (requests.RequestException, ValueError, KeyError,
+                            IndexError) as err:
+                        self.failures += 1
+                        logger.warning("Polling %s failed (%i in a row): %s",
+                                       self.url, self.failures, err)
+                    except Exception:
+                        # unexpected, but must not end the polling
+                        self.failures += 1
+                        logger.exception("Polling %s failed (%i in a row)",
+                                         self.url, self.failures)
+                self._stop.wait(self.next_wait())
+        finally:
+            # lets another worker take over if this thread ever ends
+            self._release_lock()
+
+    def _acquire_lock(self):
+        """Whether this process is the one polling the feed"""
+        if fcntl is None or self._lock_file is not None:
+            return True
+        lock_file = open(self.snapshot.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _release_lock(self):
+        # called from both the thread and stop()
+        lock_file, self._lock_file = self._lock_file, None
+        if lock_file is not None:
+            lock_file.close()
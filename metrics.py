@@ -0,0 +1,237 @@
+"""Opt-in latency instrumentation of the callbacks in app.py.
+
+Set CALLBACK_METRICS=1 to record, for every call of an instrumented
+callback, its wall time, the time of its stages (see lap), the sizes of
+its inputs (see note) and whether its figure came from the cache. Rolling
+histograms of the last calls are served on /metrics to local requests.
+Set CALLBACK_PROFILE_SLOW to a number of seconds to also sample the stacks
+of calls taking longer, including the pool threads computing them, and
+dump them to CALLBACK_PROFILE_DIR.
+"""
+
+import bisect
+import collections
+import contextlib
+import functools
+import os
+import sys
+import threading
+import time
+
+
+ENABLED = os.environ.get("CALLBACK_METRICS", "0") != "0"
+# calls kept per callback for the histograms
+WINDOW = int(os.environ.get("CALLBACK_METRICS_WINDOW", 1000))
+# calls slower than this many seconds have their samples dumped, 0 disables
+PROFILE_SLOW = float(os.environ.get("CALLBACK_PROFILE_SLOW", 0))
+PROFILE_DIR = os.environ.get("CALLBACK_PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = 0.005
+# upper edges of the histogram buckets in milliseconds
+EDGES_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_local = threading.local()
+
+
+class Call(object):
+    """Measurements of a single callback call"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.wall = None
+        self.stages = collections.OrderedDict()
+        self.notes = {}
+        # stack samples of the threads that worked on the call
+        self.stacks = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add_stacks(self, stacks):
+        with self._lock:
+            self.stacks.update(stacks)
+
+
+class Sampler(object):
+    """Samples the stack of one thread at a fixed interval, counting the
+    collapsed stacks (as read by flamegraph.pl and speedscope)"""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%i)" % (
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+
+class Metrics(object):
+    """Rolling window of the last calls of every callback"""
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._calls = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.window))
+        self._lock = threading.Lock()
+
+    def record(self, call):
+        with self._lock:
+            self._calls[call.name].append(call)
+
+    def clear(self):
+        with self._lock:
+            self._calls.clear()
+
+    def report(self):
+        """Histogram of wall times, stage percentiles, averaged notes and
+        cache hit rate of every callback"""
+        with self._lock:
+            calls = {name: list(c) for name, c in self._calls.items()}
+
+        report = {}
+        for name, recent in calls.items():
+            wall = [c.wall * 1e3 for c in recent]
+            stages = collections.defaultdict(list)
+            notes = collections.defaultdict(list)
+            for call in recent:
+                for stage, seconds in call.stages.items():
+                    stages[stage].append(seconds * 1e3)
+                for key, value in call.notes.items():
+                    notes[key].append(value)
+            hits = notes.pop("cache_hit", [])
+            report[name] = {
+                "calls": len(wall),
+                "wall_ms": summary(wall),
+                "histogram_ms": histogram(wall),
+                "stages_ms": {s: summary(v) for s, v in stages.items()},
+                "notes": {k: {"mean": sum(v) / len(v), "max": max(v)}
+                          for k, v in notes.items()},
+                "cache_hit_rate": sum(hits) / len(hits) if hits else None}
+        return report
+
+
+def summary(values):
+    """Mean and percentiles of a list of milliseconds"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(int(q * len(ordered)), len(ordered) - 1)], 3)
+
+    return {"mean": round(sum(ordered) / len(ordered), 3),
+            "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99),
+            "max": round(ordered[-1], 3)}
+
+
+def histogram(values):
+    """Pairs of bucket and number of values, for every edge of EDGES_MS
+    and above the last, kept in order as a list"""
+    counts = [0] * (len(EDGES_MS) + 1)
+    for value in values:
+        counts[bisect.bisect_left(EDGES_MS, value)] += 1
+    labels = ["<=%i" % e for e in EDGES_MS] + [">%i" % EDGES_MS[-1]]
+    return list(zip(labels, counts))
+
+
+metrics = Metrics()
+
+
+def instrument(func):
+    """Record every call of a callback. Returns func itself unless the
+    instrumentation is enabled, so that it costs nothing otherwise"""
+    if not ENABLED:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        outer = getattr(_local, "call", None)
+        call = _local.call = Call(func.__name__)
+        sampler = None
+        if PROFILE_SLOW > 0:
+            sampler = Sampler(threading.get_ident())
+            sampler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            call.wall = time.perf_counter() - call.start
+            _local.call = outer
+            metrics.record(call)
+            if sampler is not None:
+                sampler.stop()
+                call.add_stacks(sampler.stacks)
+                if call.wall > PROFILE_SLOW:
+                    dump_profile(call)
+
+    return wrapper
+
+
+def dump_profile(call):
+    """Save the stack samples of a slow call, one line per stack with its
+    number of samples"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, "%s-%i-%ims.txt" % (
+        call.name, int(time.time() * 1e3), call.wall * 1e3))
+    with call._lock:
+        stacks = call.stacks.most_common()
+    with open(path, "w") as f:
+        for stack, count in stacks:
+            f.write("%s %i\n" % (stack, count))
+
+
+def current():
+    """Call recorded in this thread, to be attached to another one"""
+    return getattr(_local, "call", None)
+
+
+@contextlib.contextmanager
+def attached(call):
+    """Record laps, notes and stack samples of this thread to a call of
+    another thread, e.g. for work it handed to a pool"""
+    outer = getattr(_local, "call", None)
+    _local.call = call
+    sampler = None
+    if PROFILE_SLOW > 0 and call is not None:
+        sampler = Sampler(threading.get_ident())
+        sampler.start()
+    try:
+        yield
+    finally:
+        _local.call = outer
+        if sampler is not None:
+            sampler.stop()
+            call.add_stacks(sampler.stacks)
+
+
+def lap(stage):
+    """Time since the start of the current call or its previous lap is
+    recorded as the given stage"""
+    call = getattr(_local, "call", None)
+    if call is not None:
+        now = time.perf_counter()
+        call.stages[stage] = call.stages.get(stage, 0.) + now - call.last
+        call.last = now
+
+
+def note(key, value):
+    """Record a number describing the current call, e.g. rows selected"""
+    call = getattr(_local, "call", None)
+    if call is not None:
+        call.notes[key] = value
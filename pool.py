@@ -0,0 +1,177 @@
+"""Bounded pool of threads the heavy callbacks of app.py run on.
+
+The gunicorn thread serving a callback hands its computation to the pool
+and waits for the result, so that at most CALLBACK_WORKERS heavy
+computations run at once while the other threads keep answering light
+requests. Identical computations in flight are shared between requests, a
+queued computation is cancelled when the same client asks for the same
+callback again (e.g. while dragging a slider) and a request waiting longer
+than the timeout of its callback is answered without an update.
+"""
+
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+import threading
+
+import dash
+import flask
+
+import metrics
+
+
+# threads computing callbacks, 0 runs them in the request thread as before
+WORKERS = int(os.environ.get("CALLBACK_WORKERS", 4))
+# computations waiting for a thread beyond which requests are turned away
+MAX_PENDING = int(os.environ.get("CALLBACK_MAX_PENDING", 32))
+# seconds a request waits for its computation by default
+TIMEOUT = float(os.environ.get("CALLBACK_TIMEOUT", 30))
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    """Computation in flight and the requests waiting for it"""
+
+    def __init__(self, key, future):
+        self.key = key
+        self.future = future
+        self.waiters = 0
+        self.clients = set()
+
+
+def client_id():
+    """Address and user agent of the client of the current request, None
+    outside of requests"""
+    if not flask.has_request_context():
+        return None
+    request = flask.request
+    address = request.access_route[0] if request.access_route \
+        else request.remote_addr
+    return address, request.headers.get("User-Agent", "")
+
+
+class CallbackPool(object):
+    """Thread pool shared by the offloaded callbacks"""
+
+    def __init__(self, workers=WORKERS, max_pending=MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.shared = 0
+        self.cancelled = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self._executor = None
+        # jobs in flight by function and arguments, and the latest job of
+        # every function and client
+        self._jobs = {}
+        self._latest = {}
+        # reentrant, as futures run their done callbacks in the thread that
+        # cancels them or finds them done
+        self._lock = threading.RLock()
+
+    def offload(self, timeout=TIMEOUT):
+        """Decorate a function to be computed on the pool, waiting at most
+        timeout seconds for it. Returns the function itself if the pool has
+        no workers"""
+
+        def decorate(func):
+            if self.workers <= 0:
+                return func
+
+            @functools.wraps(func)
+            def wrapper(*args):
+                return self.run(func, args, timeout)
+
+            return wrapper
+
+        return decorate
+
+    def run(self, func, args, timeout=TIMEOUT):
+        """Compute func(*args) on the pool, or wait for the same computation
+        already in flight. Raises PreventUpdate if it was cancelled, timed
+        out or could not be queued"""
+        key = (func.__name__, json.dumps(args, sort_keys=True, default=str))
+        client = (func.__name__, client_id())
+        job = self._join(key, func, args, client)
+        try:
+            return job.future.result(timeout)
+        except concurrent.futures.CancelledError:
+            raise dash.exceptions.PreventUpdate
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            # the computation goes on, later requests for it wait for it
+            logger.warning("%s took longer than %g s", func.__name__,
+                           timeout)
+            raise dash.exceptions.PreventUpdate
+        finally:
+            self._leave(job)
+
+    def stats(self):
+        """Counters of the pool and computations in flight"""
+        with self._lock:
+            return {"workers": self.workers, "in_flight": len(self._jobs),
+                    "shared": self.shared, "cancelled": self.cancelled,
+                    "timeouts": self.timeouts, "rejected": self.rejected}
+
+    def _join(self, key, func, args, client):
+        """Job of the computation, submitted unless in flight already, which
+        supersedes the previous job of the client"""
+        with self._lock:
+            job = self._jobs.get(key)
+            metrics.note("shared", job is not None)
+            if job is not None:
+                self.shared += 1
+            else:
+                if len(self._jobs) >= self.workers + self.max_pending:
+                    self.rejected += 1
+                    logger.warning("Turned %s away, %i computations in "
+                                   "flight", func.__name__, len(self._jobs))
+                    raise dash.exceptions.PreventUpdate
+                if self._executor is None:
+                    # started on first use, i.e. after gunicorn forked
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        self.workers, thread_name_prefix="callback")
+                job = Job(key, self._executor.submit(
+                    self._compute, func, args, metrics.current()))
+                self._jobs[key] = job
+                job.future.add_done_callback(
+                    functools.partial(self._done, job))
+            job.waiters += 1
+
+            if client[1] is not None:
+                previous = self._latest.get(client)
+                self._latest[client] = job
+                job.clients.add(client)
+                # only cancel what no other request waits for
+                if previous is not None and previous is not job and \
+                        previous.waiters == 1 and \
+                        previous.clients == {client} and \
+                        previous.future.cancel():
+                    self.cancelled += 1
+            return job
+
+    def _leave(self, job):
+        with self._lock:
+            job.waiters -= 1
+            if job.waiters == 0:
+                # forget the job, which may hold a figure, once answered
+                for known in job.clients:
+                    if self._latest.get(known) is job:
+                        del self._latest[known]
+
+    def _done(self, job, future):
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+    @staticmethod
+    def _compute(func, args, call):
+        """Run in a thread of the pool, recording its stages to the call
+        of the request that submitted it"""
+        with metrics.attached(call):
+            metrics.lap("queue")
+            return func(*args)
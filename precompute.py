@@ -0,0 +1,324 @@
+"""Parallel precompute of the aggregates of the historic data.
+
+Splits the days of the store (see store.py) across a process pool,
+computes the partial count index and heatmap counts of every day and merges
+them in order of the days into the artifacts app.py loads at startup,
+instead of building the count index and heatmap cubes itself:
+
+    python precompute.py --store data_store --out data_aggregates --jobs 8
+
+The partials of every day are kept, so that --incremental only processes
+the days that are new or changed since the last run.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import functools
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import aggregates
+import grid
+import sketches
+import store
+from boroughs import dic_borough
+
+
+AGGREGATES_PATH = "data_aggregates"
+META_FILE = "meta.json"
+DAYS_DIR = "days"
+# prefix of the directories the arrays of every run are written to
+ARRAYS_PREFIX = "arrays-"
+AGGREGATES_VERSION = 4
+# count index and heatmap cubes per resolution (see grid.py) loaded by app.py
+Artifacts = collections.namedtuple("Artifacts", ["index", "cubes"])
+
+
+@functools.lru_cache(maxsize=None)
+def open_store(store_path):
+    """Store opened once per worker process"""
+    return store.PartitionedStore(store_path)
+
+
+def store_signature(historic):
+    """What the artifacts of a store have to match to be loaded"""
+    return {"build": historic.build,
+            "days": [[p["day"], p["length"]] for p in historic.partitions]}
+
+
+def day_partial(ddf, precision=None, time_divs=aggregates.TIME_DIVS,
+                resolutions=grid.RESOLUTIONS):
+    """Count index and heatmap counts at every resolution of the pings of a
+    single day"""
+    index = aggregates.build_count_index(ddf, time_divs, precision)
+    partial = {"length": len(ddf), "day": index.first_day,
+               "route_names": np.asarray(index.route_names, dtype=str),
+               "route_hours": np.diff(index.cumulative_routes[1],
+                                      axis=0) > 0,
+               "route_flags": np.array([index.route_flags[b]
+                                        for b in index.boroughs])}
+    first_bin, last_bin = None, None
+    for resolution in resolutions:
+        heat, first_bin, last_bin = aggregates.heatmap_counts(ddf, resolution)
+        partial["heat_%s" % resolution] = heat
+    # the time bins of the located pings are the same at every resolution
+    if first_bin is None:
+        first_bin, last_bin = -1, -1
+    partial.update(first_bin=first_bin, last_bin=last_bin)
+    for div in time_divs:
+        partial["counts_%i" % div] = index.cumulative_counts[div][:, 1]
+    if precision is not None:
+        partial["sketches"] = index.sketches[:, 0]
+    return partial
+
+
+def partial_path(out_path, day):
+    return os.path.join(out_path, DAYS_DIR, "%s.npz" % day)
+
+
+def process_day(task):
+    """Compute and save the partial of one day of the store (run in the
+    pool). Returns the day"""
+    store_path, it, precision, out_path = task
+    historic = open_store(store_path)
+    day = historic.partitions[it]["day"]
+    partial = day_partial(historic.day(it), precision)
+    # what the partial was computed from, see is_current
+    partial.update(build=historic.build, checksum=historic.checksum(it))
+    path = partial_path(out_path, day)
+    # written under a temporary name so that a killed run leaves no
+    # partial behind that looks complete
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **partial)
+    os.replace(tmp_path, path)
+    return day
+
+
+def is_current(path, historic, it, precision):
+    """Whether the saved partial of a day can be reused: it has to come
+    from the same store, or from a day of another store with the same
+    content"""
+    if not os.path.exists(path):
+        return False
+    with np.load(path) as partial:
+        if "checksum" not in partial.files:
+            return False
+        same_day = (str(partial["build"]) == historic.build or
+                    str(partial["checksum"]) == historic.checksum(it))
+        length = historic.partitions[it]["length"]
+        return (same_day and int(partial["length"]) == length and
+                all("heat_%s" % r in partial.files and
+                    partial["heat_%s" % r].shape[-1] == grid.n_cells(r)
+                    for r in grid.RESOLUTIONS) and
+                (precision is None) == ("sketches" not in partial) and
+                (precision is None or
+                 partial["sketches"].shape[-1] == 2 ** precision))
+
+
+def merge(historic, partials, precision=None, time_divs=aggregates.TIME_DIVS,
+          resolutions=grid.RESOLUTIONS):
+    """Merge the partials of all days, in order of the days, into the
+    prefix sums of the count index and the summed heatmap counts"""
+    route_names = historic.categories("route_id")
+    boroughs = ["All"] + list(dic_borough)
+    first_day = int(min(p["day"] for p in partials))
+    n_days = int(max(p["day"] for p in partials)) - first_day + 1
+
+    arrays = {"route_hours": np.zeros((n_days, 24, len(route_names)),
+                                      dtype=bool),
+              "route_flags": np.zeros((len(boroughs), len(route_names)),
+                                      dtype=bool)}
+    for resolution in resolutions:
+        arrays["heat_%s" % resolution] = np.zeros(
+            (aggregates.SECONDS_PER_DAY // aggregates.HEATMAP_SLOT,
+             grid.n_cells(resolution)))
+    for div in time_divs:
+        arrays["counts_%i" % div] = np.zeros(
+            (len(boroughs), n_days, aggregates.SECONDS_PER_DAY // (div * 60),
+             3), dtype=np.int32)
+    if precision is not None:
+        arrays["sketches"] = np.zeros(
+            (len(boroughs), n_days, aggregates.SECONDS_PER_DAY //
+             aggregates.BASE_SLOT, 2 ** precision), dtype=np.uint8)
+
+    first_bin, last_bin = None, None
+    for partial in sorted(partials, key=lambda p: int(p["day"])):
+        day = int(partial["day"]) - first_day
+        routes = pd.Index(route_names).get_indexer(partial["route_names"])
+        if (routes < 0).any():
+            raise ValueError("Routes of %s missing from the store: %s" % (
+                partial["day"], partial["route_names"][routes < 0]))
+        arrays["route_hours"][day][:, routes] = partial["route_hours"]
+        arrays["route_flags"][:, routes] |= partial["route_flags"]
+        for resolution in resolutions:
+            arrays["heat_%s" % resolution] += partial["heat_%s" % resolution]
+        for div in time_divs:
+            arrays["counts_%i" % div][:, day] = partial["counts_%i" % div]
+        if precision is not None:
+            arrays["sketches"][:, day] = partial["sketches"]
+        if partial["first_bin"] >= 0:
+            first_bin = int(partial["first_bin"]) if first_bin is None \
+                else min(first_bin, int(partial["first_bin"]))
+            last_bin = int(partial["last_bin"]) if last_bin is None \
+                else max(last_bin, int(partial["last_bin"]))
+
+    # the days are accumulated once all of them are in place, so that new
+    # days only cost their own partials and one pass over the sums
+    arrays["cumulative_routes"] = aggregates.prefix_sums(
+        arrays.pop("route_hours"), [0, 1], np.int32)
+    for div in time_divs:
+        arrays["cumulative_counts_%i" % div] = aggregates.prefix_sums(
+            arrays.pop("counts_%i" % div), [1])
+
+    meta = {"first_day": first_day, "first_bin": first_bin,
+            "last_bin": last_bin}
+    return arrays, meta
+
+
+def write_artifacts(out_path, arrays, meta):
+    """Write the merged arrays as one .npy file each into a new directory,
+    then swap in the manifest pointing at it.
+
+    Workers memory-map the arrays, so the files of a previous run are never
+    written to again, only unlinked once no manifest points at them, which
+    leaves the mappings of running workers intact"""
+    arrays_path = tempfile.mkdtemp(prefix=ARRAYS_PREFIX, dir=out_path)
+    for name, values in arrays.items():
+        np.save(os.path.join(arrays_path, "%s.npy" % name), values)
+    meta = dict(meta, arrays=os.path.basename(arrays_path))
+    tmp_path = os.path.join(out_path, META_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(out_path, META_FILE))
+    for entry in os.listdir(out_path):
+        if entry.startswith(ARRAYS_PREFIX) and entry != meta["arrays"]:
+            shutil.rmtree(os.path.join(out_path, entry), ignore_errors=True)
+
+
+def run(store_path=store.STORE_PATH, out_path=AGGREGATES_PATH, jobs=None,
+        incremental=False, precision=None):
+    """Compute the partials of all days (only those new or changed if
+    incremental) in a process pool and merge them into the artifacts"""
+    historic = store.PartitionedStore(store_path)
+    if not incremental:
+        shutil.rmtree(out_path, ignore_errors=True)
+    # the artifacts of the previous run stay in place until the new ones
+    # are complete, so that a failed run leaves them loadable
+    os.makedirs(os.path.join(out_path, DAYS_DIR), exist_ok=True)
+
+    tasks = [(store_path, it, precision, out_path)
+             for it, p in enumerate(historic.partitions)
+             if not is_current(partial_path(out_path, p["day"]), historic,
+                               it, precision)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        for day in pool.map(process_day, tasks):
+            print("processed %s" % day)
+
+    partials = []
+    for p in historic.partitions:
+        with np.load(partial_path(out_path, p["day"])) as partial:
+            partials.append({k: partial[k] for k in partial.files})
+    arrays, meta = merge(historic, partials, precision)
+    meta.update(version=AGGREGATES_VERSION, store=store_signature(historic),
+                precision=precision, time_divs=list(aggregates.TIME_DIVS))
+    write_artifacts(out_path, arrays, meta)
+    print("merged %i days (%i processed) into %s" % (
+        len(partials), len(tasks), out_path))
+
+
+def load_artifacts(historic, out_path=AGGREGATES_PATH, precision=None):
+    """Count index and heatmap cubes precomputed for the store, or None if
+    missing, outdated or lacking the sketches of the given precision"""
+    try:
+        with open(os.path.join(out_path, META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != AGGREGATES_VERSION or \
+            meta["store"] != store_signature(historic) or \
+            meta["time_divs"] != list(aggregates.TIME_DIVS) or \
+            (precision is not None and meta["precision"] != precision):
+        return None
+
+    def load(name):
+        return np.load(os.path.join(out_path, meta["arrays"],
+                                    "%s.npy" % name), mmap_mode="r")
+
+    names = ["route_flags", "cumulative_routes"] + \
+        ["cumulative_counts_%i" % div for div in aggregates.TIME_DIVS]
+    if meta["precision"] is not None:
+        names.append("sketches")
+    try:
+        arrays = {name: load(name) for name in names}
+        heat = {r: np.array(load("heat_%s" % r)) for r in grid.RESOLUTIONS}
+    except OSError:
+        # replaced by a run of precompute.py since the manifest was read
+        return None
+    cubes = {r: aggregates.heatmap_cube(heat[r], meta["first_bin"],
+                                        meta["last_bin"], r)
+             for r in grid.RESOLUTIONS}
+    return Artifacts(merged_index(historic, arrays, meta), cubes)
+
+
+def merged_index(historic, arrays, meta, time_divs=aggregates.TIME_DIVS):
+    """Count index of the merged arrays, which counts the days only partially
+    covered by a query from the store itself"""
+    boroughs = ["All"] + list(dic_borough)
+    return aggregates.CountIndex(
+        boroughs, meta["first_day"],
+        {div: arrays["cumulative_counts_%i" % div] for div in time_divs},
+        historic.categories("route_id"),
+        {b: np.asarray(arrays["route_flags"][it])
+         for it, b in enumerate(boroughs)},
+        arrays["cumulative_routes"], arrays.get("sketches"))
+
+
+def build_index(historic, precision=None):
+    """Count index of the store built day by day in this process, when
+    there are no artifacts to load"""
+    partials = [day_partial(historic.day(it), precision, resolutions=[])
+                for it in range(len(historic.partitions))]
+    arrays, meta = merge(historic, partials, precision, resolutions=[])
+    return merged_index(historic, arrays, meta)
+
+
+def build_cube(historic, resolution=grid.DEFAULT_RESOLUTION):
+    """Heatmap cube of the store at a resolution built day by day in this
+    process, when there are no artifacts to load"""
+    counts = np.zeros((aggregates.SECONDS_PER_DAY // aggregates.HEATMAP_SLOT,
+                       grid.n_cells(resolution)))
+    first_bin, last_bin = None, None
+    for it in range(len(historic.partitions)):
+        heat, first, last = aggregates.heatmap_counts(historic.day(it),
+                                                      resolution)
+        counts += heat
+        if first is not None:
+            first_bin = first if first_bin is None else min(first_bin, first)
+            last_bin = last if last_bin is None else max(last_bin, last)
+    return aggregates.heatmap_cube(counts, first_bin, last_bin, resolution)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--store", default=store.STORE_PATH,
+                        help="historic store to read (see store.py)")
+    parser.add_argument("--out", default=AGGREGATES_PATH,
+                        help="directory to write the artifacts to")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="worker processes, by default one per core")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process days new or changed since the "
+                             "last run")
+    parser.add_argument("--sketches", action="store_true",
+                        help="also build the sketches of COUNT_MODE="
+                             "approximate")
+    args = parser.parse_args()
+
+    run(args.store, args.out, args.jobs, args.incremental,
+        sketches.PRECISION if args.sketches else None)
@@ -0,0 +1,69 @@
+"""HyperLogLog sketches for approximate counts of unique vehicles.
+
+A sketch holds 2 ** precision one-byte registers. Sketches of the same
+precision are merged by taking the register-wise maximum, so the sketch of
+a union of cells (e.g. the 15-minute slots making up an hour) is the
+maximum over their sketches, without going back to the pings.
+"""
+
+import hashlib
+
+import numpy as np
+
+
+# 2 ** 9 registers per sketch, about 4.6% relative standard error
+PRECISION = 9
+# bits of the hash used for the rank, so that they convert exactly to float
+RANK_BITS = 52
+
+
+def hash_ids(ids):
+    """Stable 64 bit hashes of ids, the same whichever days or order they
+    are sketched in"""
+    return np.array([int.from_bytes(hashlib.blake2b(str(i).encode(),
+                                                    digest_size=8).digest(),
+                                    "little") for i in ids], dtype=np.uint64)
+
+
+def relative_error(precision=PRECISION):
+    """Relative standard error of an estimate"""
+    return 1.04 / np.sqrt(2 ** precision)
+
+
+def build(cells, hashes, n_cells, precision=PRECISION):
+    """Sketches of shape (n_cells, 2 ** precision) of the hashed ids (see
+    hash_ids) in each cell"""
+    n_registers = 2 ** precision
+    registers = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    bits = min(64 - precision, RANK_BITS)
+    rest = (hashes & np.uint64(2 ** bits - 1)).astype(np.float64)
+    # position of the first set bit of the rest, counted from its top
+    ranks = bits + 1 - np.frexp(rest)[1]
+
+    sketches = np.zeros((n_cells, n_registers), dtype=np.uint8)
+    # largest rank per cell and register: sort keys, keep the last of a run
+    keys = np.unique((np.asarray(cells, dtype=np.int64) * n_registers +
+                      registers) * 64 + ranks)
+    slots, ranks = np.divmod(keys, 64)
+    last = np.r_[slots[1:] != slots[:-1], True]
+    sketches.reshape(-1)[slots[last]] = ranks[last]
+    return sketches
+
+
+def merge(sketches, axis):
+    """Sketch of the union of sketches along an axis"""
+    return sketches.max(axis=axis)
+
+
+def estimate(sketches):
+    """Estimated number of unique ids of sketches along the last axis"""
+    n_registers = sketches.shape[-1]
+    alpha = 0.7213 / (1 + 1.079 / n_registers)
+    inverse = np.ldexp(np.float32(1), -np.arange(65)).astype(np.float32)
+    harmonic = inverse[sketches].sum(axis=-1, dtype=np.float64)
+    raw = alpha * n_registers ** 2 / harmonic
+    # linear counting of the empty registers is more accurate for the small
+    # counts of single buckets
+    zeros = (sketches == 0).sum(axis=-1)
+    linear = n_registers * np.log(n_registers / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * n_registers) & (zeros > 0), linear, raw)
@@ -0,0 +1,354 @@
+"""Day-partitioned columnar on-disk store for the historic data.
+
+Running this module converts data.csv into a directory holding one
+sub-directory per day of pings, each with one .npy file per column sorted by
+time, plus a manifest. The columns have the compact schema of
+compact_frame. app.py memory-maps only the days a query overlaps instead of
+parsing and enriching the CSV again:
+
+    python store.py --csv data.csv --out data_store
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from aggregates import NS_PER_SECOND, SECONDS_PER_DAY, epoch_seconds
+from boroughs import borough_codes, create_boroughs
+
+
+CSV_PATH = "data.csv"
+STORE_PATH = "data_store"
+META_FILE = "meta.json"
+STORE_VERSION = 3
+# bound of the partitions kept loaded, set HISTORIC_CACHE_MB to change
+CACHE_BYTES = int(float(os.environ.get("HISTORIC_CACHE_MB", 256)) * 2 ** 20)
+
+# format of timestamps in data.csv
+timestamp = "%Y-%m-%d %H:%M:%S"
+
+
+def prepare_historic(ddf):
+    """Add borough booleans, typed timestamps and hour to raw historic data"""
+    # add borough
+    new = create_boroughs(ddf)
+    # reformat timestamp
+    new["timestamp"] = pd.to_datetime(new["timestamp"], format=timestamp)
+    new["hour"] = new["timestamp"].dt.hour.astype(np.int8)
+    return new
+
+
+def read_csv(csv_path=CSV_PATH):
+    """Load and enrich the historic data from the original CSV"""
+    ddf = pd.read_csv(csv_path, index_col=0, parse_dates=True)
+    return prepare_historic(ddf)
+
+
+def compact_frame(ddf):
+    """Historic data in the compact schema of the store: int32 seconds since
+    the epoch instead of timestamp and hour, categorical ids, float32
+    coordinates and the packed borough bits instead of the borough booleans
+    """
+    if "seconds" in ddf:
+        seconds = ddf["seconds"].values
+    else:
+        seconds = epoch_seconds(ddf["timestamp"])
+    return pd.DataFrame({
+        "seconds": seconds.astype(np.int32),
+        "vehicle_id": pd.Categorical(ddf["vehicle_id"].values),
+        "route_id": pd.Categorical(ddf["route_id"].values),
+        "latitude": ddf["latitude"].values.astype(np.float32),
+        "longitude": ddf["longitude"].values.astype(np.float32),
+        "borough": borough_codes(ddf)})
+
+
+def write_store(ddf, store_path=STORE_PATH):
+    """Write a dataframe in the compact schema as one directory per day,
+    holding one .npy file per column sorted by time, plus a manifest"""
+    os.makedirs(store_path, exist_ok=True)
+
+    ddf = compact_frame(ddf).sort_values("seconds", kind="mergesort")
+    columns = []
+    values = {}
+    for name in ddf.columns:
+        col = ddf[name]
+        entry = {"name": name}
+        if pd.api.types.is_bool_dtype(col) or \
+                pd.api.types.is_numeric_dtype(col):
+            values[name] = col.values
+        else:
+            # strings (route & vehicle ids) are stored as category codes,
+            # in the dtype pandas uses, so loading does not copy them. The
+            # categories are shared by all days so that they concatenate
+            cat = col.astype("category").cat
+            entry["categories"] = [str(c) for c in cat.categories]
+            values[name] = cat.codes.values
+        entry["dtype"] = values[name].dtype.str
+        columns.append(entry)
+
+    stamps = values["seconds"].astype(np.int64)
+    days = stamps // SECONDS_PER_DAY
+    bounds = np.flatnonzero(np.r_[True, days[1:] != days[:-1], True])
+    partitions = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        day = str(np.datetime64(int(days[start]), "D"))
+        os.makedirs(os.path.join(store_path, day))
+        for it, entry in enumerate(columns):
+            np.save(os.path.join(store_path, day, "%02i.npy" % it),
+                    values[entry["name"]][start:stop])
+        partitions.append({"day": day, "length": int(stop - start),
+                           "first": str(np.datetime64(int(stamps[start]),
+                                                      "s")),
+                           "last": str(np.datetime64(int(stamps[stop - 1]),
+                                                     "s"))})
+
+    # the build id tells aggregates computed from this store apart
+    meta = {"version": STORE_VERSION, "build": uuid.uuid4().hex,
+            "length": len(ddf), "columns": columns, "partitions": partitions}
+    # write manifest last so that a partial store is never picked up
+    tmp_path = os.path.join(store_path, META_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(store_path, META_FILE))
+
+
+class PartitionedStore(object):
+    """Historic data of a store, loading the days a query overlaps on first
+    use. Loaded days are memory-mapped read-only, so every gunicorn worker
+    shares one physical copy of them, and the least recently used days are
+    dropped once more than max_bytes are loaded"""
+
+    def __init__(self, store_path=STORE_PATH, max_bytes=CACHE_BYTES,
+                 mmap=True):
+        with open(os.path.join(store_path, META_FILE)) as f:
+            meta = json.load(f)
+        if meta["version"] != STORE_VERSION:
+            raise ValueError("Unsupported store version %s in %s" %
+                             (meta["version"], store_path))
+        self.store_path = store_path
+        self.build = meta.get("build")
+        self.max_bytes = max_bytes
+        self.mmap = mmap
+        self.columns = meta["columns"]
+        self.partitions = meta["partitions"]
+        self.days = np.array([p["day"] for p in self.partitions],
+                             dtype="datetime64[D]")
+        self.first = pd.Timestamp(self.partitions[0]["first"])
+        self.last = pd.Timestamp(self.partitions[-1]["last"])
+        self.hits = 0
+        self.misses = 0
+        self._loaded = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(p["length"] for p in self.partitions)
+
+    def overlapping(self, start_date, end_date):
+        """Indices of the days overlapping a date range, both ends included"""
+        start = np.datetime64(pd.to_datetime(start_date), "D")
+        end = np.datetime64(pd.to_datetime(end_date), "D")
+        return range(np.searchsorted(self.days, start, "left"),
+                     np.searchsorted(self.days, end, "right"))
+
+    def select(self, start_date, end_date, hours=(0, 24)):
+        """Rows between two dates (both included) within an hour range. Only
+        the overlapping days are loaded and, as they are sorted by time,
+        every day contributes one contiguous slice"""
+        # first and last whole seconds within the dates
+        start = -(-pd.to_datetime(start_date).value // NS_PER_SECOND)
+        end = pd.to_datetime(end_date).value // NS_PER_SECOND
+
+        slices = []
+        for it in self.overlapping(start_date, end_date):
+            arrays = self.partition(it)
+            stamps = arrays["seconds"]
+            day = int(self.days[it].astype(np.int64)) * SECONDS_PER_DAY
+            lower = max(start, day + hours[0] * 3600)
+            upper = day + (hours[1] + 1) * 3600
+            first = np.searchsorted(stamps, lower, "left")
+            stop = min(np.searchsorted(stamps, end, "right"),
+                       np.searchsorted(stamps, upper, "left"))
+            if stop > first:
+                slices.append({k: v[first:stop] for k, v in arrays.items()})
+        return self._frame(slices)
+
+    def day(self, it):
+        """Dataframe of a single day"""
+        return self._frame([self.partition(it)])
+
+    def checksum(self, it):
+        """Hash of the content of a day. Category codes are hashed as the
+        names they stand for, so that the hash does not change with the
+        categories other days add to the store"""
+        digest = hashlib.blake2b(digest_size=16)
+        arrays = self.partition(it)
+        for entry in self.columns:
+            values = np.asarray(arrays[entry["name"]])
+            digest.update(entry["name"].encode())
+            if "categories" in entry:
+                used, codes = np.unique(values, return_inverse=True)
+                names = np.asarray(entry["categories"], dtype=object)[used]
+                digest.update("\0".join(names).encode())
+                values = codes.astype(np.int64)
+            digest.update(np.ascontiguousarray(values).tobytes())
+        return digest.hexdigest()
+
+    def categories(self, name):
+        """Categories of a column stored as category codes"""
+        entry = [c for c in self.columns if c["name"] == name][0]
+        return np.array(entry["categories"], dtype=object)
+
+    def frame(self):
+        """The whole history as one dataframe (a copy, load it sparingly)"""
+        return self._frame([self.partition(it)
+                            for it in range(len(self.partitions))])
+
+    def partition(self, it):
+        """Column arrays of a day, loading it if needed"""
+        with self._lock:
+            if it in self._loaded:
+                self._loaded.move_to_end(it)
+                self.hits += 1
+                return self._loaded[it]
+            self.misses += 1
+
+        arrays = {}
+        day = self.partitions[it]["day"]
+        for col, entry in enumerate(self.columns):
+            arrays[entry["name"]] = np.load(
+                os.path.join(self.store_path, day, "%02i.npy" % col),
+                mmap_mode="r" if self.mmap else None)
+        size = sum(a.nbytes for a in arrays.values())
+
+        with self._lock:
+            if it not in self._loaded:
+                self._loaded[it] = arrays
+                self._bytes += size
+            # always keep the day just loaded, even if above the bound
+            while self._bytes > self.max_bytes and len(self._loaded) > 1:
+                _, dropped = self._loaded.popitem(last=False)
+                self._bytes -= sum(a.nbytes for a in dropped.values())
+            return self._loaded[it]
+
+    def stats(self):
+        """Loaded days and bytes, and hit and miss counters"""
+        with self._lock:
+            return {"loaded": len(self._loaded), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes, "days": len(self.partitions),
+                    "hits": self.hits, "misses": self.misses}
+
+    def _frame(self, slices):
+        """Dataframe of the concatenated column arrays of several days"""
+        data = {}
+        for entry in self.columns:
+            name = entry["name"]
+            if len(slices) == 1:
+                values = slices[0][name]
+            elif slices:
+                values = np.concatenate([s[name] for s in slices])
+            else:
+                values = np.empty(0, dtype=entry["dtype"])
+            if "categories" in entry:
+                values = pd.Categorical.from_codes(values,
+                                                   entry["categories"])
+            data[name] = values
+        return pd.DataFrame(data, columns=[c["name"] for c in self.columns],
+                            copy=False)
+
+
+def has_store(store_path=STORE_PATH):
+    """Whether a complete store of the current version exists at the path"""
+    try:
+        with open(os.path.join(store_path, META_FILE)) as f:
+            return json.load(f)["version"] == STORE_VERSION
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def build_store(ddf, store_path=STORE_PATH, replace=False):
+    """Write the store next to its final path and move it into place, so
+    that workers starting at the same time never see a partial store. An
+    existing store is only replaced if outdated or if asked to"""
+    parent = os.path.dirname(os.path.abspath(store_path))
+    tmp_path = tempfile.mkdtemp(prefix=".store-", dir=parent)
+    try:
+        write_store(ddf, tmp_path)
+        if os.path.exists(store_path) and \
+                (replace or not has_store(store_path)):
+            # moved aside first, as a directory can only be renamed onto
+            # an empty one
+            old_path = tempfile.mkdtemp(prefix=".store-old-", dir=parent)
+            os.rename(store_path, os.path.join(old_path, "store"))
+            shutil.rmtree(old_path, ignore_errors=True)
+        os.rename(tmp_path, store_path)
+    except OSError:
+        # another worker has already moved its store into place
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not has_store(store_path):
+            raise
+
+
+def load_historic(csv_path=CSV_PATH, store_path=STORE_PATH):
+    """Open the historic data of the store. If missing, the store is built
+    from the CSV first so that all workers map the same files"""
+    if not has_store(store_path):
+        ddf = read_csv(csv_path)
+        try:
+            build_store(ddf, store_path)
+        except OSError:
+            # e.g. read-only file system, so keep a private store instead
+            store_path = tempfile.mkdtemp(prefix="data_store-")
+            write_store(ddf, store_path)
+    return PartitionedStore(store_path)
+
+
+class HistoricLoader(object):
+    """Historic data opened in a background thread (and built first if
+    missing, see load_historic), so that importing the app does not wait
+    for it. Attributes of the store wait until it is loaded"""
+
+    def __init__(self, csv_path=CSV_PATH, store_path=STORE_PATH):
+        self.csv_path = csv_path
+        self.store_path = store_path
+        self._store = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.wait,
+                                        name="historic-loader", daemon=True)
+        self._thread.start()
+
+    @property
+    def ready(self):
+        """Whether the store is loaded"""
+        return self._store is not None
+
+    def wait(self):
+        """The loaded store. If loading in the background failed, it is
+        tried again in the calling thread, raising the error there"""
+        with self._lock:
+            if self._store is None:
+                self._store = load_historic(self.csv_path, self.store_path)
+            return self._store
+
+    def __getattr__(self, name):
+        return getattr(self.wait(), name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--csv", default=CSV_PATH,
+                        help="historic data as downloaded")
+    parser.add_argument("--out", default=STORE_PATH,
+                        help="directory to write the columnar store to")
+    args = parser.parse_args()
+
+    build_store(read_csv(args.csv), args.out, replace=True)